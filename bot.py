@@ -1,8 +1,23 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
+import re
+
+# Цикл событий на базе libuv: меньше накладных расходов на каждый callback
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass  # uvloop недоступен (например, на Windows), используем стандартный цикл
+
+from datetime import datetime
 import time
+import functools
+import heapq
+import copy
+from collections import Counter, OrderedDict
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     Message, CallbackQuery, InlineQuery, InlineQueryResultArticle, InputTextMessageContent,
@@ -11,8 +26,8 @@ from aiogram.types import (
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import os
+import msgspec
 from dotenv import load_dotenv
 
 # Импортируем функции из weather_app
@@ -22,16 +37,24 @@ from weather_app import (
     get_hourly_weather,
     get_air_pollution,
     analyze_air_pollution,
-    get_coordinates
+    get_coordinates,
+    get_coordinates_many,
+    close_session
 )
 
 # Импортируем функции хранения данных
-from storage import load_user, save_user, load_all_users, cleanup_old_cache, normalize_coordinates, clear_user_cache
+from storage import (
+    load_user, save_user, load_all_users, load_notification_schedule, batch_writes,
+    cleanup_old_cache, normalize_coordinates, clear_user_cache,
+    UserProfile, Location, NotifData
+)
 
 load_dotenv()
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
+# httpx пишет каждый запрос в INFO вместе с URL, а в URL - API ключ OpenWeather
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Инициализация бота
@@ -39,18 +62,36 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в .env файле")
 
-bot = Bot(token=BOT_TOKEN)
+# Режим работы: polling (по умолчанию, для разработки) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL не найден в .env файле (обязателен для BOT_MODE=webhook)")
+
+# JSON-парсинг ответов Telegram через msgspec (C-декодер) вместо стандартного json
+_json_encoder = msgspec.json.Encoder()
+_json_decoder = msgspec.json.Decoder()
+
+def _json_dumps(value) -> str:
+    return _json_encoder.encode(value).decode()
+
+session = AiohttpSession(json_loads=_json_decoder.decode, json_dumps=_json_dumps)
+bot = Bot(token=BOT_TOKEN, session=session)
+# Username бота не меняется во время работы: запрашивается один раз в main()
+BOT_USERNAME: str | None = None
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 
-# Загружаем данные пользователей из файла
+# Загружаем данные пользователей из базы ({user_id: UserProfile})
 user_data = {}
 try:
-    all_users = load_all_users()
-    # Преобразуем строковые ID в int
-    for user_id_str, data in all_users.items():
-        user_data[int(user_id_str)] = data
+    user_data.update(load_all_users())
     logger.info(f"Загружено данных {len(user_data)} пользователей")
 except Exception as e:
     logger.error(f"Ошибка загрузки данных: {e}")
@@ -59,7 +100,7 @@ except Exception as e:
 try:
     deleted = cleanup_old_cache()
     if deleted > 0:
-        logger.info(f"Удалено {deleted} устаревших файлов кэша")
+        logger.info(f"Удалено {deleted} устаревших записей кэша")
 except Exception as e:
     logger.error(f"Ошибка очистки кэша: {e}")
 
@@ -74,6 +115,64 @@ class WeatherStates(StatesGroup):
 
 # ============= ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ДАННЫХ =============
 
+# Фоновая запись данных пользователей: обработчики и цикл уведомлений не ждут запись в базу
+SAVE_BATCH_DELAY_SECONDS = 0.1
+SAVE_BATCH_MAX_SIZE = 32
+_save_queue = asyncio.Queue()
+_save_worker_task = None
+
+def enqueue_user_save(user_id: int) -> None:
+    """Поставить сохранение данных пользователя в фоновую очередь"""
+    # Копия, чтобы последующие изменения user_data не попали в уже поставленную запись
+    _save_queue.put_nowait((user_id, copy.deepcopy(user_data[user_id])))
+
+def _write_user_batch(batch: list) -> None:
+    """Записать пачку изменений одной транзакцией"""
+    with batch_writes():
+        for user_id, data in batch:
+            save_user(user_id, data)
+
+async def _save_worker():
+    """Собирает записи в пачки (до SAVE_BATCH_MAX_SIZE или SAVE_BATCH_DELAY_SECONDS) и пишет их в потоке"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await _save_queue.get()]
+        deadline = loop.time() + SAVE_BATCH_DELAY_SECONDS
+        
+        while len(batch) < SAVE_BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_save_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await asyncio.to_thread(_write_user_batch, batch)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения данных пользователей: {e}")
+        finally:
+            for _ in batch:
+                _save_queue.task_done()
+
+async def start_save_worker():
+    """Запуск фоновой записи (dp.startup)"""
+    global _save_worker_task
+    _save_worker_task = asyncio.create_task(_save_worker())
+
+async def stop_save_worker():
+    """Дописать оставшиеся изменения и остановить фоновую запись (dp.shutdown)"""
+    await _save_queue.join()
+    if _save_worker_task:
+        _save_worker_task.cancel()
+
+def get_saved_location(user_id: int) -> Location | None:
+    """Сохраненное местоположение пользователя или None"""
+    profile = user_data.get(user_id)
+    return profile.location if profile else None
+
 def update_user_location(user_id: int, lat: float, lon: float, city: str) -> None:
     """
     Обновить местоположение пользователя с очисткой старого кэша
@@ -88,43 +187,82 @@ def update_user_location(user_id: int, lat: float, lon: float, city: str) -> Non
     norm_lat, norm_lon = normalize_coordinates(lat, lon)
     
     # Проверяем, изменились ли координаты
-    if user_id in user_data and user_data[user_id].get('location'):
-        old_location = user_data[user_id]['location']
-        old_lat = old_location.get('lat')
-        old_lon = old_location.get('lon')
+    old_location = get_saved_location(user_id)
+    if old_location:
+        old_lat, old_lon = old_location.lat, old_location.lon
         
         # Если координаты изменились, очищаем старый кэш
-        if old_lat is not None and old_lon is not None:
-            if abs(old_lat - norm_lat) > 0.01 or abs(old_lon - norm_lon) > 0.01:  # Изменение > 1км
-                clear_user_cache(old_lat, old_lon)
-                logger.info(f"Очищен кэш для старых координат пользователя {user_id}")
+        if abs(old_lat - norm_lat) > 0.01 or abs(old_lon - norm_lon) > 0.01:  # Изменение > 1км
+            clear_user_cache(old_lat, old_lon)
+            logger.info(f"Очищен кэш для старых координат пользователя {user_id}")
     
     # Обновляем данные с нормализованными координатами
     if user_id not in user_data:
-        user_data[user_id] = {}
+        user_data[user_id] = UserProfile()
     
-    user_data[user_id]['location'] = {'lat': norm_lat, 'lon': norm_lon, 'city': city}
+    user_data[user_id].location = Location(lat=norm_lat, lon=norm_lon, city=city)
     
-    # Сохраняем в файл
-    save_user(user_id, user_data[user_id])
+    # Сохраняем в файл в фоне
+    enqueue_user_save(user_id)
+
+def _parse_coords(data: str) -> tuple[float | None, float | None]:
+    """
+    Извлечь координаты из callback_data вида "action|lat|lon"
+    
+    Returns:
+        tuple: (lat, lon), округленные как ключ кэша, или (None, None), если координат нет
+    """
+    _, _, rest = data.partition('|')
+    lat_s, _, lon_s = rest.partition('|')
+    if lat_s and lon_s:
+        return normalize_coordinates(float(lat_s), float(lon_s))
+    return None, None
 
 # ============= КЛАВИАТУРЫ =============
 
+# Статичные клавиатуры собираются один раз при загрузке модуля
+MAIN_MENU_ROWS = [
+    [InlineKeyboardButton(text="🌤 Поиск по названию", callback_data="current_weather")],
+    [InlineKeyboardButton(text="🧭 Поиск по геолокации", callback_data="geo_search")],
+    [InlineKeyboardButton(text="🏛 Сравнение городов", callback_data="compare_cities")],
+    [InlineKeyboardButton(text="🔔 Погодные уведомления", callback_data="notifications")]
+]
+MAIN_MENU_NO_LOC = InlineKeyboardMarkup(inline_keyboard=MAIN_MENU_ROWS)
+
+CANCEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="back_to_menu")]
+])
+
+MAIN_MENU_BUTTON = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
+])
+
+# Размер кэша клавиатур, зависящих от координат
+KEYBOARD_CACHE_SIZE = 2048
+
+def _round_coords(lat, lon):
+    """
+    Округлить координаты для кэша клавиатур
+    
+    Та же сетка, что у кэша погоды (normalize_coordinates): все точки одной
+    ячейки ~1 км получают один и тот же объект клавиатуры.
+    """
+    if lat is None or lon is None:
+        return None, None
+    return normalize_coordinates(lat, lon)
+
 def get_main_menu(user_id=None):
     """Главное меню бота"""
-    buttons = [
-        [InlineKeyboardButton(text="🌤 Поиск по названию", callback_data="current_weather")],
-        [InlineKeyboardButton(text="🧭 Поиск по геолокации", callback_data="geo_search")],
-        [InlineKeyboardButton(text="🏛 Сравнение городов", callback_data="compare_cities")],
-        [InlineKeyboardButton(text="🔔 Погодные уведомления", callback_data="notifications")]
-    ]
-    
     # Добавляем кнопку с сохраненным городом, если есть
-    if user_id and user_id in user_data and user_data[user_id].get('location'):
-        city = user_data[user_id]['location'].get('city', 'Ваше местоположение')
-        buttons.insert(0, [InlineKeyboardButton(text=f"📍 Погода {city}", callback_data="weather_saved_location")])
+    location = get_saved_location(user_id) if user_id else None
+    if location:
+        city = location.city or 'Ваше местоположение'
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"📍 Погода {city}", callback_data="weather_saved_location")],
+            *MAIN_MENU_ROWS
+        ])
     
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return MAIN_MENU_NO_LOC
 
 def get_weather_actions_menu(lat=None, lon=None):
     """
@@ -133,6 +271,10 @@ def get_weather_actions_menu(lat=None, lon=None):
     Args:
         lat, lon: Координаты (для inline режима и stateless кнопок)
     """
+    return _build_weather_actions_menu(*_round_coords(lat, lon))
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _build_weather_actions_menu(lat, lon):
     coords = f"{lat}|{lon}" if lat is not None and lon is not None else None
     
     ext_cb = f"extended_data|{coords}" if coords else "extended_data"
@@ -158,18 +300,20 @@ def get_location_keyboard():
 
 def get_cancel_keyboard():
     """Клавиатура с кнопкой отмены"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="back_to_menu")]
-    ])
+    return CANCEL_KB
 
 def get_forecast_keyboard(days_data, lat=None, lon=None):
     """Клавиатура для навигации по прогнозу"""
+    dates = tuple(day_info['date'] for day_info in days_data)
+    return _build_forecast_keyboard(dates, *_round_coords(lat, lon))
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _build_forecast_keyboard(dates, lat, lon):
     buttons = []
     coords = f"{lat}|{lon}" if lat is not None and lon is not None else None
     back_cb = f"back_to_weather|{coords}" if coords else "back_to_weather"
     
-    for i, day_info in enumerate(days_data):
-        date_str = day_info['date']
+    for i, date_str in enumerate(dates):
         day_cb = f"day_{i}|{coords}" if coords else f"day_{i}"
         buttons.append([InlineKeyboardButton(text=f"📅 {date_str}", callback_data=day_cb)])
         
@@ -180,6 +324,10 @@ def get_forecast_keyboard(days_data, lat=None, lon=None):
 
 def get_back_button(lat=None, lon=None):
     """Кнопка возврата"""
+    return _build_back_button(*_round_coords(lat, lon))
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _build_back_button(lat, lon):
     coords = f"{lat}|{lon}" if lat is not None and lon is not None else None
     fc_cb = f"forecast_5days|{coords}" if coords else "forecast_5days"
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -189,6 +337,10 @@ def get_back_button(lat=None, lon=None):
 
 def get_extended_data_keyboard(lat=None, lon=None):
     """Клавиатура для расширенных данных"""
+    return _build_extended_data_keyboard(*_round_coords(lat, lon))
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _build_extended_data_keyboard(lat, lon):
     coords = f"{lat}|{lon}" if lat is not None and lon is not None else None
     back_cb = f"back_to_weather|{coords}" if coords else "back_to_weather"
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -198,24 +350,18 @@ def get_extended_data_keyboard(lat=None, lon=None):
 
 def get_forecast_navigation_keyboard(lat=None, lon=None):
     """Клавиатура навигации для прогноза"""
-    coords = f"{lat}|{lon}" if lat is not None and lon is not None else None
-    back_cb = f"back_to_weather|{coords}" if coords else "back_to_weather"
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data=back_cb)],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
-    ])
+    # Совпадает с клавиатурой расширенных данных, переиспользуем кэш
+    return get_extended_data_keyboard(lat, lon)
 
 def get_main_menu_button():
     """Простая кнопка главного меню"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
-    ])
+    return MAIN_MENU_BUTTON
 
 def get_notifications_keyboard(user_id, is_enabled):
     """Клавиатура управления уведомлениями"""
-    notif_data = user_data[user_id].get('notification_data', {})
-    location = notif_data.get('location', {}).get('city', 'Не задан')
-    interval = notif_data.get('interval', 2)
+    notif_data = user_data[user_id].notification_data or NotifData()
+    location = notif_data.location.city if notif_data.location else 'Не задан'
+    interval = notif_data.interval
     
     status = "✅ Включены" if is_enabled else "❌ Выключены"
     toggle_action = "Выключить" if is_enabled else "Включить"
@@ -231,27 +377,71 @@ def get_notifications_keyboard(user_id, is_enabled):
 
 # ============= ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =============
 
+# Кэш отформатированных сообщений (повторные нажатия "Назад" не пересчитывают текст)
+RENDER_CACHE_TTL_SECONDS = 600  # 10 минут, как и у кэша API
+RENDER_CACHE_MAX_SIZE = 1024
+_render_cache = OrderedDict()
+
+def get_cached_render(key: tuple, render, *args):
+    """
+    Получить результат форматирования из кэша или вычислить его
+    
+    К ключу добавляется временная корзина, поэтому запись живет
+    не дольше RENDER_CACHE_TTL_SECONDS.
+    
+    Args:
+        key: Ключ кэша (тип сообщения, нормализованные координаты и т.д.)
+        render: Функция форматирования
+        *args: Аргументы для render
+    """
+    full_key = (*key, int(time.time() // RENDER_CACHE_TTL_SECONDS))
+    
+    if full_key in _render_cache:
+        _render_cache.move_to_end(full_key)
+        return _render_cache[full_key]
+    
+    result = render(*args)
+    _render_cache[full_key] = result
+    if len(_render_cache) > RENDER_CACHE_MAX_SIZE:
+        _render_cache.popitem(last=False)
+    return result
+
+def cached_render(key_func):
+    """Декоратор: кэширует форматирование по ключу, вычисленному из данных"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(data):
+            return get_cached_render((func.__name__, *key_func(data)), func, data)
+        return wrapper
+    return decorator
+
+def _weather_render_key(data: dict) -> tuple:
+    """Ключ для текущей погоды: координаты + время измерения + локальное имя"""
+    lat, lon = normalize_coordinates(data['coord']['lat'], data['coord']['lon'])
+    return lat, lon, data['dt'], data.get('_local_name')
+
+def _forecast_render_key(forecast_data: dict) -> tuple:
+    """Ключ для прогноза: координаты + время первой записи"""
+    coord = forecast_data['city']['coord']
+    lat, lon = normalize_coordinates(coord['lat'], coord['lon'])
+    first_dt = forecast_data['list'][0]['dt'] if forecast_data['list'] else None
+    return lat, lon, first_dt
+
+@cached_render(_weather_render_key)
 def format_weather_message(data: dict) -> str:
     """Форматирование сообщения о текущей погоде"""
-    temp = data['main']['temp']
-    feels_like = data['main']['feels_like']
-    humidity = data['main']['humidity']
-    pressure = data['main']['pressure']
-    wind_speed = data['wind']['speed']
-    description = data['weather'][0]['description'].capitalize()
+    # Вложенные словари читаются один раз, дальше - только одно f-выражение
+    main = data['main']
     # Используем локальное имя, если есть, иначе из API
-    city = data.get('_local_name', data['name'])
-    country = data['sys']['country']
-    
-    message = f"🌍 <b>{city}, {country}</b>\n\n"
-    message += f"🌡 Температура: <b>{temp}°C</b>\n"
-    message += f"🤔 Ощущается как: {feels_like}°C\n"
-    message += f"💧 Влажность: {humidity}%\n"
-    message += f"🌪 Ветер: {wind_speed} м/с\n"
-    message += f"📊 Давление: {pressure} гПа\n"
-    message += f"☁️ {description}"
-    
-    return message
+    return (
+        f"🌍 <b>{data.get('_local_name', data['name'])}, {data['sys']['country']}</b>\n\n"
+        f"🌡 Температура: <b>{main['temp']}°C</b>\n"
+        f"🤔 Ощущается как: {main['feels_like']}°C\n"
+        f"💧 Влажность: {main['humidity']}%\n"
+        f"🌪 Ветер: {data['wind']['speed']} м/с\n"
+        f"📊 Давление: {main['pressure']} гПа\n"
+        f"☁️ {data['weather'][0]['description'].capitalize()}"
+    )
 
 
 POLLUTANT_ICONS = {
@@ -275,11 +465,9 @@ ASSESSMENT_ICONS = {
 }
 
 def get_pollutant_emoji(name):
-    # Проверяем точное совпадение ключа в начале строки (так как name = "NO₂ (диоксид азота)")
-    for key, icon in POLLUTANT_ICONS.items():
-        if name.startswith(key):
-            return icon
-    return "🧪"
+    # Ключ - первое слово названия (name = "NO₂ (диоксид азота)")
+    token = name.split(' ', 1)[0]
+    return POLLUTANT_ICONS.get(token, "🧪")
 
 def get_assessment_emoji(assessment):
     return ASSESSMENT_ICONS.get(assessment, "⚪")
@@ -304,62 +492,77 @@ def format_extended_weather(weather_data: dict, air_data: dict, pollution_analys
     # UV индекс (если есть)
     uvi = weather_data.get('uvi', 'Н/Д')
     
-    message = f"🌍 <b>{city}, {country}</b>\n\n"
-    message += f"<b>📊 ОСНОВНЫЕ ДАННЫЕ</b>\n"
-    message += f"🌡 Температура: <b>{temp}°C</b> (ощущается как {feels_like}°C)\n"
-    message += f"💧 Влажность: {humidity}%\n"
-    message += f"🌪 Ветер: {wind_speed} м/с\n"
-    message += f"📊 Давление: {pressure} гПа\n"
-    message += f"☁️ Облачность: {cloudiness}%\n"
-    message += f"🌤 {description}\n\n"
-    
-    message += f"<b>🌅 СОЛНЦЕ</b>\n"
-    message += f"🌄 Восход: {sunrise}\n"
-    message += f"🌇 Закат: {sunset}\n\n"
+    parts = [
+        f"🌍 <b>{city}, {country}</b>\n\n",
+        "<b>📊 ОСНОВНЫЕ ДАННЫЕ</b>\n",
+        f"🌡 Температура: <b>{temp}°C</b> (ощущается как {feels_like}°C)\n",
+        f"💧 Влажность: {humidity}%\n",
+        f"🌪 Ветер: {wind_speed} м/с\n",
+        f"📊 Давление: {pressure} гПа\n",
+        f"☁️ Облачность: {cloudiness}%\n",
+        f"🌤 {description}\n\n",
+        "<b>🌅 СОЛНЦЕ</b>\n",
+        f"🌄 Восход: {sunrise}\n",
+        f"🌇 Закат: {sunset}\n\n"
+    ]
     
     if uvi != 'Н/Д':
-        message += f"<b>☀️ UV ИНДЕКС</b>\n"
-        message += f"UV: {uvi}\n\n"
+        parts.append("<b>☀️ UV ИНДЕКС</b>\n")
+        parts.append(f"UV: {uvi}\n\n")
     
     # Загрязнение воздуха
-    message += f"<b>🏭 КАЧЕСТВО ВОЗДУХА</b>\n"
-    message += f"Общий статус: <b>{pollution_analysis['overall_status']}</b>\n\n"
+    parts.append("<b>🏭 КАЧЕСТВО ВОЗДУХА</b>\n")
+    parts.append(f"Общий статус: <b>{pollution_analysis['overall_status']}</b>\n\n")
     
     if pollution_analysis['details']:
-        message += "<b>Детали загрязнения:</b>\n"
+        parts.append("<b>Детали загрязнения:</b>\n")
         for detail in pollution_analysis['details'][:6]:  # Показываем первые 6
             pollutant_name = detail['pollutant']
             icon = get_pollutant_emoji(pollutant_name)
             assessment = detail['assessment']
             status_icon = get_assessment_emoji(assessment)
             
-            message += f"{icon} {pollutant_name}: {detail['value']} - {status_icon} {assessment}\n"
+            parts.append(f"{icon} {pollutant_name}: {detail['value']} - {status_icon} {assessment}\n")
     
-    return message
+    return "".join(parts)
 
+@cached_render(_forecast_render_key)
 def parse_forecast_data(forecast_data: dict) -> list:
     """Парсинг данных прогноза на 5 дней"""
     daily_forecasts = {}
     
+    # Один проход: накапливаем min/max/суммы и счетчик описаний по каждому дню.
+    # datetime создается один раз на запись; ключ дня и время "ЧЧ:ММ" собираются
+    # из его полей без strftime
     for item in forecast_data['list']:
         dt = datetime.fromtimestamp(item['dt'])
-        date_key = dt.strftime('%Y-%m-%d')
+        date_key = (dt.year, dt.month, dt.day)
         
-        if date_key not in daily_forecasts:
-            daily_forecasts[date_key] = {
+        day = daily_forecasts.get(date_key)
+        if day is None:
+            day = daily_forecasts[date_key] = {
                 'date': dt.strftime('%d.%m (%a)'),
-                'temps': [],
-                'descriptions': [],
-                'humidity': [],
-                'wind': [],
-                'items': []
+                'temp_min': float('inf'),
+                'temp_max': float('-inf'),
+                'hum_sum': 0,
+                'wind_sum': 0.0,
+                'count': 0,
+                'desc_counter': Counter(),
+                'items': [],
+                'hours': []
             }
         
-        daily_forecasts[date_key]['temps'].append(item['main']['temp'])
-        daily_forecasts[date_key]['descriptions'].append(item['weather'][0]['description'])
-        daily_forecasts[date_key]['humidity'].append(item['main']['humidity'])
-        daily_forecasts[date_key]['wind'].append(item['wind']['speed'])
-        daily_forecasts[date_key]['items'].append(item)
+        temp = item['main']['temp']
+        if temp < day['temp_min']:
+            day['temp_min'] = temp
+        if temp > day['temp_max']:
+            day['temp_max'] = temp
+        day['hum_sum'] += item['main']['humidity']
+        day['wind_sum'] += item['wind']['speed']
+        day['count'] += 1
+        day['desc_counter'][item['weather'][0]['description']] += 1
+        day['items'].append(item)
+        day['hours'].append(f"{dt.hour:02d}:{dt.minute:02d}")
     
     # Формируем итоговый список
     result = []
@@ -367,12 +570,13 @@ def parse_forecast_data(forecast_data: dict) -> list:
         day_data = daily_forecasts[date_key]
         result.append({
             'date': day_data['date'],
-            'temp_min': min(day_data['temps']),
-            'temp_max': max(day_data['temps']),
-            'description': max(set(day_data['descriptions']), key=day_data['descriptions'].count),
-            'humidity_avg': sum(day_data['humidity']) // len(day_data['humidity']),
-            'wind_avg': sum(day_data['wind']) / len(day_data['wind']),
-            'items': day_data['items']
+            'temp_min': day_data['temp_min'],
+            'temp_max': day_data['temp_max'],
+            'description': day_data['desc_counter'].most_common(1)[0][0],
+            'humidity_avg': day_data['hum_sum'] // day_data['count'],
+            'wind_avg': day_data['wind_sum'] / day_data['count'],
+            'items': day_data['items'],
+            'hours': day_data['hours']  # Локальное время каждой записи из items
         })
     
     return result
@@ -390,29 +594,38 @@ WEATHER_ICONS = {
     "50d": "🌫", "50n": "🌫"
 }
 
+# Плоская таблица по коду иконки "NNx": индекс (NN << 1) | (x == 'n'), источник - WEATHER_ICONS
+_ICON_TABLE = ["•"] * (100 << 1)
+for _code, _emoji in WEATHER_ICONS.items():
+    _ICON_TABLE[(int(_code[:2]) << 1) | (_code[2] == 'n')] = _emoji
+_ICON_TABLE = tuple(_ICON_TABLE)
+
 def get_weather_emoji(icon_code):
-    return WEATHER_ICONS.get(icon_code, "•")
+    try:
+        return _ICON_TABLE[(int(icon_code[:2]) << 1) | (icon_code[2] == 'n')]
+    except (ValueError, IndexError, TypeError):
+        return "•"
 
 def format_day_details(day_data: dict) -> str:
     """Форматирование детальной информации о дне"""
-    message = f"📅 <b>{day_data['date']}</b>\n\n"
-    message += f"🌡 Температура: {day_data['temp_min']:.1f}°C ... {day_data['temp_max']:.1f}°C\n"
-    message += f"☁️ {day_data['description'].capitalize()}\n"
-    message += f"💧 Влажность: ~{day_data['humidity_avg']}%\n"
-    message += f"🌪 Ветер: ~{day_data['wind_avg']:.1f} м/с\n\n"
-    
-    message += "<b>Почасовой прогноз:</b>\n"
-    for item in day_data['items'][:8]:  # Показываем до 8 записей
-        dt = datetime.fromtimestamp(item['dt'])
-        time_str = dt.strftime('%H:%M')
-        temp = item['main']['temp']
-        desc = item['weather'][0]['description']
-        icon_code = item['weather'][0]['icon']
-        emoji = get_weather_emoji(icon_code)
-        
-        message += f"{emoji} {time_str}: {temp}°C, {desc}\n"
+    parts = [
+        f"📅 <b>{day_data['date']}</b>\n\n",
+        f"🌡 Температура: {day_data['temp_min']:.1f}°C ... {day_data['temp_max']:.1f}°C\n",
+        f"☁️ {day_data['description'].capitalize()}\n",
+        f"💧 Влажность: ~{day_data['humidity_avg']}%\n",
+        f"🌪 Ветер: ~{day_data['wind_avg']:.1f} м/с\n\n",
+        "<b>Почасовой прогноз:</b>\n"
+    ]
     
-    return message
+    # Показываем до 8 записей
+    parts.extend(
+        f"{get_weather_emoji(item['weather'][0]['icon'])} "
+        f"{hour}: "
+        f"{item['main']['temp']}°C, {item['weather'][0]['description']}\n"
+        for item, hour in zip(day_data['items'][:8], day_data['hours'])
+    )
+    
+    return "".join(parts)
 
 def format_comparison(city1_data: dict, city2_data: dict) -> str:
     """Форматирование сравнения двух городов"""
@@ -422,45 +635,143 @@ def format_comparison(city1_data: dict, city2_data: dict) -> str:
     city2 = city2_data.get('_local_name', city2_data['name'])
     country2 = city2_data['sys']['country']
     
-    temp1 = city1_data['main']['temp']
-    temp2 = city2_data['main']['temp']
-    
-    feels1 = city1_data['main']['feels_like']
-    feels2 = city2_data['main']['feels_like']
-    
-    humidity1 = city1_data['main']['humidity']
-    humidity2 = city2_data['main']['humidity']
+    main1 = city1_data['main']
+    main2 = city2_data['main']
+    temp1 = main1['temp']
+    temp2 = main2['temp']
+    
+    return (
+        f"🏙 <b>Сравнение городов</b>\n\n"
+        f"<b>{city1}, {country1}</b> vs <b>{city2}, {country2}</b>\n\n"
+        f"🌡 Температура:\n"
+        f"  • {city1}: <b>{temp1}°C</b>\n"
+        f"  • {city2}: <b>{temp2}°C</b>\n"
+        f"  Разница: {abs(temp1 - temp2):.1f}°C\n\n"
+        
+        f"🤔 Ощущается:\n"
+        f"  • {city1}: {main1['feels_like']}°C\n"
+        f"  • {city2}: {main2['feels_like']}°C\n\n"
+        
+        f"💧 Влажность:\n"
+        f"  • {city1}: {main1['humidity']}%\n"
+        f"  • {city2}: {main2['humidity']}%\n\n"
+        
+        f"🌪 Ветер:\n"
+        f"  • {city1}: {city1_data['wind']['speed']} м/с\n"
+        f"  • {city2}: {city2_data['wind']['speed']} м/с\n\n"
+        
+        f"☁️ Условия:\n"
+        f"  • {city1}: {city1_data['weather'][0]['description']}\n"
+        f"  • {city2}: {city2_data['weather'][0]['description']}"
+    )
+
+# Последнее содержимое каждого сообщения: {(chat_id, message_id): (хэш текста, хэш клавиатуры)}
+LAST_RENDERED_MAX_SIZE = 4096
+_last_rendered = OrderedDict()
+
+def _message_key(message: Message) -> tuple:
+    return message.chat.id, message.message_id
+
+def _markup_hash(markup) -> int | None:
+    """Хэш клавиатуры (по JSON, т.к. модели aiogram не хэшируются)"""
+    return hash(markup.model_dump_json()) if markup else None
+
+def _remember_rendered(key: tuple, rendered: tuple) -> None:
+    _last_rendered[key] = rendered
+    _last_rendered.move_to_end(key)
+    if len(_last_rendered) > LAST_RENDERED_MAX_SIZE:
+        _last_rendered.popitem(last=False)
+
+async def edit_text_cached(message: Message, text: str, **kwargs) -> None:
+    """
+    Отредактировать сообщение, пропуская запрос, если содержимое не изменилось
     
-    wind1 = city1_data['wind']['speed']
-    wind2 = city2_data['wind']['speed']
+    Telegram отвечает на такое редактирование ошибкой 'message is not modified',
+    поэтому лишний запрос не отправляется вовсе. Ошибки редактирования пробрасываются.
+    """
+    key = _message_key(message)
+    rendered = (hash((text, kwargs.get('parse_mode'))), _markup_hash(kwargs.get('reply_markup')))
+    if _last_rendered.get(key) == rendered:
+        return
     
-    desc1 = city1_data['weather'][0]['description']
-    desc2 = city2_data['weather'][0]['description']
+    await message.edit_text(text, **kwargs)
+    _remember_rendered(key, rendered)
+
+async def edit_markup_cached(message: Message, reply_markup) -> None:
+    """Заменить только клавиатуру сообщения, пропуская запрос, если она не изменилась"""
+    key = _message_key(message)
+    markup_hash = _markup_hash(reply_markup)
+    previous = _last_rendered.get(key)
+    if previous is not None and previous[1] == markup_hash:
+        return
     
-    message = f"🏙 <b>Сравнение городов</b>\n\n"
-    message += f"<b>{city1}, {country1}</b> vs <b>{city2}, {country2}</b>\n\n"
-    message += f"🌡 Температура:\n"
-    message += f"  • {city1}: <b>{temp1}°C</b>\n"
-    message += f"  • {city2}: <b>{temp2}°C</b>\n"
-    message += f"  Разница: {abs(temp1 - temp2):.1f}°C\n\n"
+    await message.edit_reply_markup(reply_markup=reply_markup)
+    # Текст не менялся; если он неизвестен, следующий edit_text_cached не будет пропущен
+    _remember_rendered(key, (previous[0] if previous else None, markup_hash))
+
+async def safe_edit_text(message: Message, text: str, **kwargs) -> None:
+    """Отредактировать сообщение, игнорируя ошибку 'message is not modified'"""
+    try:
+        await edit_text_cached(message, text, **kwargs)
+    except TelegramBadRequest as e:
+        # Остальные ошибки (сообщение удалено, ошибка разметки, слишком длинный текст)
+        # должны дойти до обработчика
+        if "message is not modified" not in e.message:
+            raise
+
+async def edit_callback_message(callback: CallbackQuery, text: str, answer_text: str | None = None,
+                                **kwargs) -> bool:
+    """
+    Отредактировать сообщение с кнопкой и ответить на callback
     
-    message += f"🤔 Ощущается:\n"
-    message += f"  • {city1}: {feels1}°C\n"
-    message += f"  • {city2}: {feels2}°C\n\n"
+    Сначала редактирование, затем ответ: на callback можно ответить только один раз,
+    и если редактирование не удалось, ответом становится алерт с ошибкой.
     
-    message += f"💧 Влажность:\n"
-    message += f"  • {city1}: {humidity1}%\n"
-    message += f"  • {city2}: {humidity2}%\n\n"
+    Args:
+        callback: Нажатие кнопки
+        text: Новый текст сообщения
+        answer_text: Текст уведомления при успешном редактировании
+        **kwargs: Параметры edit_text (parse_mode, reply_markup)
     
-    message += f"🌪 Ветер:\n"
-    message += f"  • {city1}: {wind1} м/с\n"
-    message += f"  • {city2}: {wind2} м/с\n\n"
+    Returns:
+        bool: True, если сообщение отредактировано
+    """
+    try:
+        await safe_edit_text(callback.message, text, **kwargs)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось отредактировать сообщение: {e.message}")
+        await callback.answer("⚠️ Не удалось обновить сообщение", show_alert=True)
+        return False
+    await callback.answer(answer_text)
+    return True
+
+# Разобранный прогноз хранится в FSM-данных пользователя между нажатиями кнопок дней
+FORECAST_STATE_TTL_SECONDS = 1800
+
+async def remember_forecast_days(state: FSMContext, lat: float, lon: float, days_data: list) -> None:
+    """Сохранить разобранный прогноз в FSM-данных пользователя"""
+    await state.update_data(forecast={
+        'coords': (lat, lon),
+        'days': days_data,
+        'saved_at': time.time()
+    })
+
+async def get_forecast_days(state: FSMContext, lat: float, lon: float) -> list:
+    """
+    Получить разобранный прогноз по дням
     
-    message += f"☁️ Условия:\n"
-    message += f"  • {city1}: {desc1}\n"
-    message += f"  • {city2}: {desc2}"
+    Сначала берется сохраненный в FSM результат forecast_5days (если он для
+    тех же координат и не старше FORECAST_STATE_TTL_SECONDS), иначе прогноз
+    запрашивается и разбирается заново.
+    """
+    forecast = (await state.get_data()).get('forecast')
+    if (forecast and tuple(forecast['coords']) == (lat, lon)
+            and time.time() - forecast['saved_at'] < FORECAST_STATE_TTL_SECONDS):
+        return forecast['days']
     
-    return message
+    days_data = parse_forecast_data(await get_hourly_weather(lat, lon))
+    await remember_forecast_days(state, lat, lon, days_data)
+    return days_data
 
 # ============= ОБРАБОТЧИКИ КОМАНД =============
 
@@ -469,7 +780,7 @@ async def cmd_start(message: Message):
     """Обработчик команды /start"""
     user_id = message.from_user.id
     if user_id not in user_data:
-        user_data[user_id] = {'location': None}
+        user_data[user_id] = UserProfile()
     
     welcome_text = (
         f"👋 Привет, {message.from_user.first_name}!\n\n"
@@ -484,11 +795,11 @@ async def cmd_start(message: Message):
 async def back_to_menu(callback: CallbackQuery):
     """Возврат в главное меню"""
     user_id = callback.from_user.id
-    await callback.message.edit_text(
+    await edit_callback_message(
+        callback,
         "Выберите интересующее вас действие из меню ниже: 👇",
         reply_markup=get_main_menu(user_id)
     )
-    await callback.answer()
 
 
 @router.callback_query(F.data == "weather_saved_location")
@@ -496,19 +807,19 @@ async def weather_saved_location(callback: CallbackQuery):
     """Погода для сохраненного местоположения"""
     user_id = callback.from_user.id
     
-    if user_id not in user_data or not user_data[user_id].get('location'):
+    location = get_saved_location(user_id)
+    if not location:
         await callback.answer("Местоположение не сохранено", show_alert=True)
         return
     
-    location = user_data[user_id]['location']
-    
     try:
-        weather_data = get_weather_by_coordinates(location['lat'], location['lon'], location.get('city'))
+        weather_data = await get_weather_by_coordinates(location.lat, location.lon, location.city)
         formatted_message = format_weather_message(weather_data)
-        await callback.message.edit_text(
+        await safe_edit_text(
+            callback.message,
             formatted_message, 
             parse_mode="HTML", 
-            reply_markup=get_weather_actions_menu(location['lat'], location['lon'])
+            reply_markup=get_weather_actions_menu(location.lat, location.lon)
         )
         await callback.answer()
     except Exception as e:
@@ -519,25 +830,18 @@ async def back_to_weather(callback: CallbackQuery):
     """Возврат к погоде"""
     user_id = callback.from_user.id
     
-    lat_param, lon_param = None, None
-    if "|" in callback.data:
-        parts = callback.data.split("|")
-        if len(parts) >= 3:
-            lat_param = parts[1]
-            lon_param = parts[2]
-    
     try:
-        if lat_param and lon_param:
-            lat, lon = float(lat_param), float(lon_param)
-            city_name = None 
-        elif user_id in user_data and user_data[user_id].get('location'):
-            location = user_data[user_id]['location']
-            lat, lon, city_name = location['lat'], location['lon'], location.get('city')
+        lat, lon = _parse_coords(callback.data)
+        location = get_saved_location(user_id)
+        if lat is not None:
+            city_name = None
+        elif location:
+            lat, lon, city_name = location.lat, location.lon, location.city
         else:
             await callback.answer("Местоположение не сохранено", show_alert=True)
             return
 
-        weather_data = get_weather_by_coordinates(lat, lon, city_name)
+        weather_data = await get_weather_by_coordinates(lat, lon, city_name)
         formatted_message = format_weather_message(weather_data)
         
         reply_markup = get_weather_actions_menu(lat, lon)
@@ -549,25 +853,18 @@ async def back_to_weather(callback: CallbackQuery):
                 parse_mode="HTML",
                 reply_markup=reply_markup
              )
+             await callback.answer()
         else:
-            try:
-                await callback.message.edit_text(formatted_message, parse_mode="HTML", reply_markup=reply_markup)
-            except Exception:
-                pass  # Игнорируем ошибку, если сообщение не изменилось
-            
-        await callback.answer()
+            await edit_callback_message(callback, formatted_message, parse_mode="HTML", reply_markup=reply_markup)
     except Exception as e:
+        # Сюда попадаем до ответа на callback (ошибка API), поэтому алерт еще можно показать
         await callback.answer("Не удалось получить погоду", show_alert=True)
 
 @router.callback_query(F.data == "current_weather")
 async def current_weather_callback(callback: CallbackQuery, state: FSMContext):
     """Запрос текущей погоды"""
-    try:
-        await callback.message.edit_text("🌤 Введите название города:")
-    except Exception:
-        pass
-    await state.set_state(WeatherStates.waiting_for_city)
-    await callback.answer()
+    if await edit_callback_message(callback, "🌤 Введите название города:"):
+        await state.set_state(WeatherStates.waiting_for_city)
 
 @router.message(WeatherStates.waiting_for_city)
 async def process_city_weather(message: Message, state: FSMContext):
@@ -577,10 +874,9 @@ async def process_city_weather(message: Message, state: FSMContext):
     
     try:
         # Получаем погоду и русское название города
-        weather_data, city_name_ru = get_weather(city)        
+        weather_data, city_name_ru = await get_weather(city)        
         # Сохраняем местоположение пользователя с русским названием
-        lat = weather_data['coord']['lat']
-        lon = weather_data['coord']['lon']
+        lat, lon = normalize_coordinates(weather_data['coord']['lat'], weather_data['coord']['lon'])
         update_user_location(user_id, lat, lon, city_name_ru)
         formatted_message = format_weather_message(weather_data)
         await message.answer(
@@ -595,43 +891,36 @@ async def process_city_weather(message: Message, state: FSMContext):
         await state.clear()
 
 @router.callback_query(F.data.startswith("forecast_5days"))
-async def forecast_5days_callback(callback: CallbackQuery):
+async def forecast_5days_callback(callback: CallbackQuery, state: FSMContext):
     """Прогноз на 5 дней"""
     user_id = callback.from_user.id
     
-    lat_param, lon_param = None, None
-    if "|" in callback.data:
-        parts = callback.data.split("|")
-        if len(parts) >= 3:
-            lat_param = parts[1]
-            lon_param = parts[2]
-            
     try:
-        lat, lon, city_name = None, None, None
-        
-        if lat_param and lon_param:
-            lat, lon = float(lat_param), float(lon_param)
-        elif user_id in user_data and user_data[user_id].get('location'):
-            location = user_data[user_id]['location']
-            lat, lon = location['lat'], location['lon']
-            city_name = location.get('city', 'Ваше местоположение')
-        else:
-            if not callback.inline_message_id:
-                try:
-                    await callback.message.edit_text(
-                        "📍 Сначала отправьте свое местоположение, чтобы получить прогноз.",
-                        reply_markup=get_main_menu()
-                    )
-                except:
-                    pass
-            await callback.answer("Местоположение не сохранено")
+        city_name = None
+        lat, lon = _parse_coords(callback.data)
+        location = get_saved_location(user_id)
+        
+        if lat is None and location:
+            lat, lon = location.lat, location.lon
+            city_name = location.city or 'Ваше местоположение'
+        elif lat is None:
+            if callback.inline_message_id:
+                await callback.answer("Местоположение не сохранено")
+            else:
+                await edit_callback_message(
+                    callback,
+                    "📍 Сначала отправьте свое местоположение, чтобы получить прогноз.",
+                    answer_text="Местоположение не сохранено",
+                    reply_markup=get_main_menu()
+                )
             return
         
-        forecast_data = get_hourly_weather(lat, lon)
+        forecast_data = await get_hourly_weather(lat, lon)
         days_data = parse_forecast_data(forecast_data)
+        await remember_forecast_days(state, lat, lon, days_data)
         
         message_text = f"📅 <b>Прогноз на 5 дней</b>\n🌍 {city_name}\n\nВыберите день:"
-        reply_markup = get_forecast_keyboard(days_data, city_name)
+        reply_markup = get_forecast_keyboard(days_data, lat, lon)
         
         if callback.inline_message_id:
              await bot.edit_message_text(
@@ -640,72 +929,52 @@ async def forecast_5days_callback(callback: CallbackQuery):
                 parse_mode="HTML",
                 reply_markup=reply_markup
              )
+             await callback.answer()
         else:
-            try:
-                await callback.message.edit_text(
-                    message_text,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup
-                )
-            except:
-                pass
-        await callback.answer()
+            await edit_callback_message(callback, message_text, parse_mode="HTML", reply_markup=reply_markup)
     except Exception as e:
+        # Сюда попадаем до ответа на callback: ошибка получения или разбора прогноза
         error_text = f"❌ Ошибка получения прогноза: {str(e)}"
         if callback.inline_message_id:
              # В inline режиме просто показываем алерт, чтобы не ломать сообщение
              await callback.answer(error_text, show_alert=True)
         else:
-            try:
-                await callback.message.edit_text(
-                    error_text,
-                    reply_markup=get_main_menu()
-                )
-            except:
-                pass
-            await callback.answer()
+            await edit_callback_message(callback, error_text, reply_markup=get_main_menu())
 
 @router.callback_query(F.data.startswith("day_"))
-async def show_day_details(callback: CallbackQuery):
+async def show_day_details(callback: CallbackQuery, state: FSMContext):
     """Показать детали конкретного дня"""
     user_id = callback.from_user.id
     
     # Парсим данные: day_0|lat|lon
-    data_parts = callback.data.split("|")
-    day_part = data_parts[0]
-    day_index = int(day_part.split("_")[1])
+    day_part, _, _ = callback.data.partition("|")
+    day_index = int(day_part[len("day_"):])
     
-    lat_param, lon_param = None, None
-    if len(data_parts) >= 3:
-        lat_param =  data_parts[1]
-        lon_param = data_parts[2]
-        
     try:
-        lat, lon = None, None
-        
-        if lat_param and lon_param:
-             lat, lon = float(lat_param), float(lon_param)
-        elif user_id in user_data and user_data[user_id].get('location'):
-             location = user_data[user_id]['location']
-             lat, lon = location['lat'], location['lon']
-             city_name = location.get('city', 'Ваше местоположение')
-        else:
+        lat, lon = _parse_coords(callback.data)
+        location = get_saved_location(user_id)
+        
+        if lat is None and location:
+             lat, lon = location.lat, location.lon
+        elif lat is None:
              if not callback.inline_message_id:
                  await callback.answer("Местоположение не найдено", show_alert=True)
              else:
                  await callback.answer("Местоположение не найдено. Попробуйте обновить поиск.", show_alert=True)
              return
 
-        # Получаем данные прогноза из кэша
-        forecast_data = get_hourly_weather(lat, lon)
-        days_data = parse_forecast_data(forecast_data)
+        # Берем прогноз, разобранный при открытии списка дней
+        days_data = await get_forecast_days(state, lat, lon)
         
         if day_index >= len(days_data):
             await callback.answer("День не найден", show_alert=True)
             return
         
         day_data = days_data[day_index]
-        message_text = format_day_details(day_data)
+        norm_lat, norm_lon = normalize_coordinates(lat, lon)
+        message_text = get_cached_render(
+            ("format_day_details", norm_lat, norm_lon, day_data['date']), format_day_details, day_data
+        )
         
         reply_markup = get_back_button(lat, lon)
         
@@ -716,13 +985,9 @@ async def show_day_details(callback: CallbackQuery):
                 parse_mode="HTML",
                 reply_markup=reply_markup
              )
+             await callback.answer()
         else:
-            await callback.message.edit_text(
-                message_text,
-                parse_mode="HTML",
-                reply_markup=reply_markup
-            )
-        await callback.answer()
+            await edit_callback_message(callback, message_text, parse_mode="HTML", reply_markup=reply_markup)
     except Exception as e:
         await callback.answer(f"Ошибка: {str(e)}", show_alert=True)
 
@@ -741,27 +1006,23 @@ async def geo_search_callback(callback: CallbackQuery, state: FSMContext):
 async def process_location(message: Message):
     """Обработка полученной геолокации"""
     user_id = message.from_user.id
-    lat = message.location.latitude
-    lon = message.location.longitude
+    # Округляем до ~1 км, чтобы соседние точки попадали в один кэш
+    lat, lon = normalize_coordinates(message.location.latitude, message.location.longitude)
     
     try:
-        weather_data = get_weather_by_coordinates(lat, lon)
+        weather_data = await get_weather_by_coordinates(lat, lon)
         city_name = weather_data['name']
         
-        # Сохраняем местоположение пользователя
         # Сохраняем местоположение пользователя
         update_user_location(user_id, lat, lon, city_name)
         
-        # Удаляем клавиатуру геолокации
-        try:
-            msg = await message.answer("🔎", reply_markup=ReplyKeyboardRemove())
-            await msg.delete()
-        except:
-            pass
+        # Подтверждение заодно убирает клавиатуру геолокации (у сообщения
+        # может быть только одна клавиатура, поэтому погода идет вторым сообщением)
+        await message.answer("✅ Местоположение сохранено!", reply_markup=ReplyKeyboardRemove())
         
         formatted_message = format_weather_message(weather_data)
         await message.answer(
-            f"✅ Местоположение сохранено!\n\n{formatted_message}",
+            formatted_message,
             parse_mode="HTML",
             reply_markup=get_weather_actions_menu(lat, lon)
         )
@@ -814,24 +1075,21 @@ async def process_manual_coordinates(message: Message, state: FSMContext):
             )
             return
         
+        lat, lon = normalize_coordinates(lat, lon)
+        
         # Получаем погоду по координатам
-        weather_data = get_weather_by_coordinates(lat, lon)
+        weather_data = await get_weather_by_coordinates(lat, lon)
         city_name = weather_data['name']
         
-        # Сохраняем местоположение пользователя
         # Сохраняем местоположение пользователя
         update_user_location(user_id, lat, lon, city_name)
         
-        # Удаляем клавиатуру
-        try:
-            msg = await message.answer("🔎", reply_markup=ReplyKeyboardRemove())
-            await msg.delete()
-        except:
-            pass
+        # Подтверждение заодно убирает клавиатуру ввода координат
+        await message.answer("✅ Местоположение сохранено!", reply_markup=ReplyKeyboardRemove())
         
         formatted_message = format_weather_message(weather_data)
         await message.answer(
-            f"✅ Местоположение сохранено!\n\n{formatted_message}",
+            formatted_message,
             parse_mode="HTML",
             reply_markup=get_weather_actions_menu(lat, lon)
         )
@@ -858,72 +1116,69 @@ async def notifications_menu(callback: CallbackQuery):
     
     # Инициализируем данные если их нет
     if user_id not in user_data:
-        user_data[user_id] = {'location': None}
+        user_data[user_id] = UserProfile()
         
-    notif_data = user_data[user_id].get('notification_data')
-    is_enabled = notif_data.get('enabled', False) if notif_data else False
+    notif_data = user_data[user_id].notification_data
+    is_enabled = notif_data.enabled if notif_data else False
     
-    await callback.message.edit_text(
+    await edit_callback_message(
+        callback,
         "🔔 <b>Погодные уведомления</b>\n\n"
         "Настройте уведомления, чтобы получать погоду по расписанию.\n"
         "Уведомления приходят независимо от изменений погоды.",
         reply_markup=get_notifications_keyboard(user_id, is_enabled),
         parse_mode="HTML"
     )
-    await callback.answer()
 
 @router.callback_query(F.data == "toggle_notifications")
 async def toggle_notifications(callback: CallbackQuery):
     """Включение/выключение уведомлений"""
     user_id = callback.from_user.id
     
-    notif_data = user_data[user_id].get('notification_data', {})
-    is_enabled = not notif_data.get('enabled', False)
+    profile = user_data[user_id]
+    notif_data = profile.notification_data or NotifData()
+    is_enabled = not notif_data.enabled
     
     if is_enabled:
         # Включаем
         # Если локация для уведомлений не задана, пробуем взять из основной
-        if not notif_data.get('location'):
-            current_loc = user_data[user_id].get('location')
-            if current_loc:
-                notif_data['location'] = current_loc
+        if not notif_data.location:
+            if profile.location:
+                notif_data.location = profile.location
             else:
                 await callback.answer("Сначала задайте город для уведомлений!", show_alert=True)
                 return
 
-        notif_data['enabled'] = True
-        notif_data['interval'] = notif_data.get('interval', 2)
+        notif_data.enabled = True
         # Запускаем через интервал (не сразу)
-        notif_data['next_run'] = time.time() + (notif_data['interval'] * 3600)
+        notif_data.next_run = time.time() + (notif_data.interval * 3600)
         
-        user_data[user_id]['notification_data'] = notif_data
-        save_user(user_id, user_data[user_id])
+        profile.notification_data = notif_data
+        enqueue_user_save(user_id)
         
         schedule_user_notification(user_id)
         status_text = "включены"
     else:
         # Выключаем
-        notif_data['enabled'] = False
-        user_data[user_id]['notification_data'] = notif_data
-        save_user(user_id, user_data[user_id])
+        notif_data.enabled = False
+        profile.notification_data = notif_data
+        enqueue_user_save(user_id)
         
         schedule_user_notification(user_id)
         status_text = "выключены"
         
-    await callback.message.edit_reply_markup(
-        reply_markup=get_notifications_keyboard(user_id, is_enabled)
-    )
+    await edit_markup_cached(callback.message, get_notifications_keyboard(user_id, is_enabled))
     await callback.answer(f"Уведомления {status_text}")
 
 @router.callback_query(F.data == "set_notification_city")
 async def set_notification_city_start(callback: CallbackQuery, state: FSMContext):
     """Начало настройки города для уведомлений"""
-    await callback.message.edit_text(
+    if await edit_callback_message(
+        callback,
         "🏙 Введите название города для уведомлений:",
         reply_markup=get_cancel_keyboard()
-    )
-    await state.set_state(WeatherStates.waiting_for_notification_city)
-    await callback.answer()
+    ):
+        await state.set_state(WeatherStates.waiting_for_notification_city)
 
 @router.message(WeatherStates.waiting_for_notification_city)
 async def set_notification_city_finish(message: Message, state: FSMContext):
@@ -932,28 +1187,23 @@ async def set_notification_city_finish(message: Message, state: FSMContext):
     city = message.text.strip()
     
     try:
-        lat, lon, city_name = get_coordinates(city)
+        lat, lon, city_name = await get_coordinates(city)
+        lat, lon = normalize_coordinates(lat, lon)
         
-        if 'notification_data' not in user_data[user_id]:
-            user_data[user_id]['notification_data'] = {}
+        profile = user_data[user_id]
+        if profile.notification_data is None:
+            profile.notification_data = NotifData()
             
-        user_data[user_id]['notification_data']['location'] = {
-            'lat': lat, 'lon': lon, 'city': city_name
-        }
-        
-        # Если уведомления включены, обновляем задачу
-        if user_data[user_id]['notification_data'].get('enabled'):
-             schedule_user_notification(user_id)
-
-        save_user(user_id, user_data[user_id])
+        profile.notification_data.location = Location(lat=lat, lon=lon, city=city_name)
+        enqueue_user_save(user_id)
         
         # Перепланируем если включено (чтобы обновить данные, но время останется прежним)
-        if user_data[user_id]['notification_data'].get('enabled'):
+        if profile.notification_data.enabled:
             schedule_user_notification(user_id)
         
         await message.answer(
             f"✅ Город для уведомлений установлен: {city_name}",
-            reply_markup=get_notifications_keyboard(user_id, user_data[user_id]['notification_data'].get('enabled'))
+            reply_markup=get_notifications_keyboard(user_id, profile.notification_data.enabled)
         )
         await state.clear()
         
@@ -966,12 +1216,12 @@ async def set_notification_city_finish(message: Message, state: FSMContext):
 @router.callback_query(F.data == "set_notification_interval")
 async def set_notification_interval_start(callback: CallbackQuery, state: FSMContext):
     """Начало настройки интервала"""
-    await callback.message.edit_text(
+    if await edit_callback_message(
+        callback,
         "⏱ Введите интервал в часах (например: 2, 24, или 0.1 для теста):",
         reply_markup=get_cancel_keyboard()
-    )
-    await state.set_state(WeatherStates.waiting_for_interval)
-    await callback.answer()
+    ):
+        await state.set_state(WeatherStates.waiting_for_interval)
 
 @router.message(WeatherStates.waiting_for_interval)
 async def set_notification_interval_finish(message: Message, state: FSMContext):
@@ -985,22 +1235,23 @@ async def set_notification_interval_finish(message: Message, state: FSMContext):
         if interval <= 0:
             raise ValueError
         
-        if 'notification_data' not in user_data[user_id]:
-             user_data[user_id]['notification_data'] = {}
+        profile = user_data[user_id]
+        if profile.notification_data is None:
+             profile.notification_data = NotifData()
              
-        user_data[user_id]['notification_data']['interval'] = interval
+        profile.notification_data.interval = interval
         # Сбрасываем таймер на новый интервал (чтобы не ждать старого огромного времени или не получать старое короткое)
-        user_data[user_id]['notification_data']['next_run'] = time.time() + (interval * 3600)
+        profile.notification_data.next_run = time.time() + (interval * 3600)
         
-        save_user(user_id, user_data[user_id])
+        enqueue_user_save(user_id)
         
         # Перепланируем если включено
-        if user_data[user_id]['notification_data'].get('enabled'):
+        if profile.notification_data.enabled:
             schedule_user_notification(user_id)
             
         await message.answer(
             f"✅ Интервал установлен: {interval} ч.\nСледующее уведомление через {interval} ч.",
-            reply_markup=get_notifications_keyboard(user_id, user_data[user_id]['notification_data'].get('enabled'))
+            reply_markup=get_notifications_keyboard(user_id, profile.notification_data.enabled)
         )
         await state.clear()
     except ValueError:
@@ -1012,11 +1263,11 @@ async def set_notification_interval_finish(message: Message, state: FSMContext):
 @router.callback_query(F.data == "compare_cities")
 async def compare_cities_callback(callback: CallbackQuery, state: FSMContext):
     """Сравнение городов"""
-    await callback.message.edit_text(
+    if await edit_callback_message(
+        callback,
         "🏙 Введите два города через запятую:\n\nНапример: Москва, Санкт-Петербург"
-    )
-    await state.set_state(WeatherStates.waiting_for_two_cities)
-    await callback.answer()
+    ):
+        await state.set_state(WeatherStates.waiting_for_two_cities)
 
 @router.message(WeatherStates.waiting_for_two_cities)
 async def process_city_comparison(message: Message, state: FSMContext):
@@ -1033,8 +1284,12 @@ async def process_city_comparison(message: Message, state: FSMContext):
         return
     
     try:
-        city1_data, _ = get_weather(cities[0])
-        city2_data, _ = get_weather(cities[1])
+        # Оба города запрашиваются одновременно
+        (lat1, lon1, name1), (lat2, lon2, name2) = await get_coordinates_many(cities)
+        city1_data, city2_data = await asyncio.gather(
+            get_weather_by_coordinates(lat1, lon1, name1),
+            get_weather_by_coordinates(lat2, lon2, name2)
+        )
         
         comparison_message = format_comparison(city1_data, city2_data)
         await message.answer(comparison_message, parse_mode="HTML", reply_markup=get_main_menu_button())
@@ -1051,36 +1306,30 @@ async def extended_data_callback(callback: CallbackQuery, state: FSMContext):
     """Расширенные данные о погоде"""
     user_id = callback.from_user.id
     
-    lat_param, lon_param = None, None
-    if "|" in callback.data:
-        parts = callback.data.split("|")
-        if len(parts) >= 3:
-            lat_param = parts[1]
-            lon_param = parts[2]
-    
     # Пытаемся получить координаты
     try:
-        if lat_param and lon_param:
-            lat, lon = float(lat_param), float(lon_param)
+        lat, lon = _parse_coords(callback.data)
+        location = get_saved_location(user_id)
+        if lat is not None:
             city_name = None
-        elif user_id in user_data and user_data[user_id].get('location'):
-             location = user_data[user_id]['location']
-             lat, lon = location['lat'], location['lon']
-             city_name = location.get('city', 'Ваше местоположение')
+        elif location:
+             lat, lon = location.lat, location.lon
+             city_name = location.city or 'Ваше местоположение'
         else:
             # Если местоположения нет и это не inline, просим ввести
-            if not callback.inline_message_id:
-                await callback.message.edit_text(
-                    "📊 Введите название города или отправьте геолокацию для получения расширенных данных:"
-                )
-                await state.set_state(WeatherStates.waiting_for_extended_input)
-            else:
+            if callback.inline_message_id:
                 await callback.answer("Местоположение не задано", show_alert=True)
-            await callback.answer()
+            elif await edit_callback_message(
+                callback,
+                "📊 Введите название города или отправьте геолокацию для получения расширенных данных:"
+            ):
+                await state.set_state(WeatherStates.waiting_for_extended_input)
             return
 
-        weather_data = get_weather_by_coordinates(lat, lon)
-        air_data = get_air_pollution(lat, lon)
+        weather_data, air_data = await asyncio.gather(
+            get_weather_by_coordinates(lat, lon),
+            get_air_pollution(lat, lon)
+        )
         pollution_analysis = analyze_air_pollution(air_data)
         
         extended_message = format_extended_weather(weather_data, air_data, pollution_analysis)
@@ -1097,12 +1346,13 @@ async def extended_data_callback(callback: CallbackQuery, state: FSMContext):
         else:
             # Если не удалось отредактировать, отправляем новое сообщение
             try:
-                await callback.message.edit_text(
+                await edit_text_cached(
+                    callback.message,
                     extended_message,
                     parse_mode="HTML",
                     reply_markup=reply_markup
                 )
-            except:
+            except TelegramBadRequest:
                 await callback.message.answer(
                     extended_message,
                     parse_mode="HTML",
@@ -1115,14 +1365,7 @@ async def extended_data_callback(callback: CallbackQuery, state: FSMContext):
         if callback.inline_message_id:
             await callback.answer(error_text, show_alert=True)
         else:
-            try:
-                await callback.message.edit_text(
-                    error_text,
-                    reply_markup=get_main_menu()
-                )
-            except:
-                pass
-        await callback.answer()
+            await edit_callback_message(callback, error_text, reply_markup=get_main_menu())
 
 @router.message(WeatherStates.waiting_for_extended_input)
 async def process_extended_data(message: Message, state: FSMContext):
@@ -1130,12 +1373,12 @@ async def process_extended_data(message: Message, state: FSMContext):
     
     if message.location:
         # Обработка геолокации
-        lat = message.location.latitude
-        lon = message.location.longitude
+        lat, lon = normalize_coordinates(message.location.latitude, message.location.longitude)
     elif message.text:
         # Обработка названия города
         try:
-            lat, lon, city_name = get_coordinates(message.text.strip())
+            lat, lon, city_name = await get_coordinates(message.text.strip())
+            lat, lon = normalize_coordinates(lat, lon)
         except Exception as e:
             await message.answer(
                 f"❌ Ошибка: {str(e)}",
@@ -1152,8 +1395,10 @@ async def process_extended_data(message: Message, state: FSMContext):
         return
     
     try:
-        weather_data = get_weather_by_coordinates(lat, lon)
-        air_data = get_air_pollution(lat, lon)
+        weather_data, air_data = await asyncio.gather(
+            get_weather_by_coordinates(lat, lon),
+            get_air_pollution(lat, lon)
+        )
         pollution_analysis = analyze_air_pollution(air_data)
         
         extended_message = format_extended_weather(weather_data, air_data, pollution_analysis)
@@ -1181,11 +1426,10 @@ async def inline_weather_query(query: InlineQuery):
         
     try:
         # Пытаемся получить погоду
-        weather_data, city_name_ru = get_weather(text)
+        weather_data, city_name_ru = await get_weather(text)
         
         # Получаем координаты из ответа API
-        lat = weather_data['coord']['lat']
-        lon = weather_data['coord']['lon']
+        lat, lon = normalize_coordinates(weather_data['coord']['lat'], weather_data['coord']['lon'])
         
         # Формируем сообщение
         message_text = format_weather_message(weather_data)
@@ -1194,9 +1438,7 @@ async def inline_weather_query(query: InlineQuery):
         icon_code = weather_data['weather'][0]['icon']
         icon_url = f"https://openweathermap.org/img/wn/{icon_code}@2x.png"
         
-        # Получаем данные о боте для ссылки
-        bot_info = await bot.get_me()
-        bot_link = f"https://t.me/{bot_info.username}"
+        bot_link = f"https://t.me/{BOT_USERNAME}"
         
         # Обновляем текст сообщения, добавляя ссылку
         message_text += f"\n\n🤖 <a href='{bot_link}'>Посмотреть в боте</a>"
@@ -1206,7 +1448,7 @@ async def inline_weather_query(query: InlineQuery):
         
         # Создаем результат
         result = InlineQueryResultArticle(
-            id=str(time.time()),
+            id=query.id,  # Один результат на запрос: id запроса уже уникален
             title=f"{city_name_ru}: {weather_data['main']['temp']}°C",
             description=f"{weather_data['weather'][0]['description'].capitalize()}",
             input_message_content=InputTextMessageContent(
@@ -1220,16 +1462,25 @@ async def inline_weather_query(query: InlineQuery):
         
         await query.answer([result], cache_time=1, is_personal=False)
         
-    except Exception as e:
-        # Если ошибка, просто не отвечаем (Telegram покажет пустой список)
-        # Логируем для отладки
-        # logger.error(f"Inline error: {e}")
-        pass
+    except Exception:
+        # Не отвечаем на запрос (Telegram покажет пустой список), но пишем в лог
+        logger.exception("Inline error")
 
 # ============= ФОНОВЫЕ ЗАДАЧИ =============
 
-# Глобальный планировщик
-scheduler = AsyncIOScheduler()
+CACHE_CLEANUP_INTERVAL_SECONDS = 3600
+# Одновременных отправок уведомлений (глобальный лимит Telegram ~30 сообщений/сек)
+NOTIFICATION_SEND_CONCURRENCY = 25
+
+# Очередь уведомлений: куча (время запуска, user_id) и один таймер на всех пользователей
+_notification_heap = []
+# Актуальное время запуска для каждого пользователя; записи кучи с другим временем устарели
+_scheduled_at = {}
+_notification_wakeup = asyncio.Event()
+_notification_send_limit = asyncio.Semaphore(NOTIFICATION_SEND_CONCURRENCY)
+_background_tasks = []
+# Пачки уведомлений, которые сейчас отправляются (ссылки, чтобы задачи не собрал GC)
+_notification_batches = set()
 
 
 async def send_weather_notification(user_id: int):
@@ -1238,22 +1489,28 @@ async def send_weather_notification(user_id: int):
         if user_id not in user_data:
             return
             
-        notif_data = user_data[user_id].get('notification_data')
-        if not notif_data or not notif_data.get('enabled') or not notif_data.get('location'):
+        notif_data = user_data[user_id].notification_data
+        if not notif_data or not notif_data.enabled or not notif_data.location:
             return
-            
-        location = notif_data['location']
-        weather_data = get_weather_by_coordinates(location['lat'], location['lon'])
         
-        # Обновляем время следующего запуска
-        interval = notif_data.get('interval', 2)
-        notif_data['next_run'] = time.time() + (interval * 3600)
-        save_user(user_id, user_data[user_id])
+        # Обновляем время следующего запуска (даже если отправка ниже не удастся).
+        # Отсчет от запланированного, а не текущего времени: задержки отправки не
+        # накапливаются. Пропущенные за время простоя запуски пропускаем целиком
+        now = time.time()
+        step = notif_data.interval * 3600
+        next_run = (notif_data.next_run or now) + step
+        if next_run <= now:
+            next_run += ((now - next_run) // step + 1) * step
+        notif_data.next_run = next_run
+        enqueue_user_save(user_id)
+        
+        location = notif_data.location
+        weather_data = await get_weather_by_coordinates(location.lat, location.lon)
         
         # Формируем сообщение
         temp = weather_data['main']['temp']
         description = weather_data['weather'][0]['description']
-        city = location['city']
+        city = location.city
         
         message = (
             f"🔔 <b>Погодное уведомление</b>\n"
@@ -1264,70 +1521,136 @@ async def send_weather_notification(user_id: int):
         
         
         # Генерация клавиатуры с действиями
-        reply_markup = get_weather_actions_menu(location['lat'], location['lon'])
+        reply_markup = get_weather_actions_menu(location.lat, location.lon)
         
-        await bot.send_message(user_id, message, parse_mode="HTML", reply_markup=reply_markup)
+        async with _notification_send_limit:
+            await bot.send_message(user_id, message, parse_mode="HTML", reply_markup=reply_markup)
         logger.info(f"Отправлено уведомление пользователю {user_id}")
         
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления для {user_id}: {e}")
 
+def _first_run_time(next_run: float, now: float) -> float:
+    """Если время следующего запуска в прошлом, запускаем через 10 сек"""
+    return next_run if next_run > now else now + 10
+
+def _notification_run_time(user_id: int, now: float) -> float | None:
+    """Время ближайшего уведомления пользователя или None, если уведомления выключены"""
+    profile = user_data.get(user_id)
+    notif_data = profile.notification_data if profile else None
+    if not notif_data or not notif_data.enabled:
+        return None
+    return _first_run_time(notif_data.next_run, now)
+
 def schedule_user_notification(user_id: int):
-    """Планирование задачи уведомления для пользователя"""
-    job_id = f"weather_notif_{user_id}"
+    """Планирование уведомления для пользователя"""
+    # Старая запись в куче (если есть) станет неактуальной и будет пропущена
+    _scheduled_at.pop(user_id, None)
     
-    # Удаляем старую задачу если есть
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
-        
-    if user_id not in user_data:
+    next_run = _notification_run_time(user_id, time.time())
+    if next_run is None:
         return
+    
+    _scheduled_at[user_id] = next_run
+    heapq.heappush(_notification_heap, (next_run, user_id))
+    # Будим цикл: новая запись может оказаться раньше текущей ближайшей
+    _notification_wakeup.set()
+    logger.info(f"Запланировано уведомление для {user_id} (интервал {user_data[user_id].notification_data.interval}ч)")
 
-    notif_data = user_data[user_id].get('notification_data')
-    if not notif_data or not notif_data.get('enabled'):
-        return
-        
-    interval = notif_data.get('interval', 2)
-    next_run = notif_data.get('next_run', 0)
+def restore_notifications() -> int:
+    """
+    Запланировать уведомления всех пользователей при запуске
     
-    # Если время следующего запуска в прошлом, запускаем сейчас
-    run_date = None
-    if next_run > time.time():
-        run_date = datetime.fromtimestamp(next_run)
-    else:
-        run_date = datetime.now() + timedelta(seconds=10) # Запуск через 10 сек
-        
-    scheduler.add_job(
-        send_weather_notification,
-        'interval',
-        hours=interval,
-        start_date=run_date,
-        args=[user_id],
-        id=job_id
-    )
-    logger.info(f"Запланировано уведомление для {user_id} (интервал {interval}ч)")
+    Включенные пользователи выбираются из базы по индексу, записи
+    превращаются в кучу одним heapify (O(N)), без отдельного heappush
+    и пробуждения цикла на каждого пользователя.
+    
+    Returns:
+        int: Количество запланированных уведомлений
+    """
+    now = time.time()
+    entries = []
+    for user_id, next_run, _ in load_notification_schedule():
+        run_at = _first_run_time(next_run, now)
+        _scheduled_at[user_id] = run_at
+        entries.append((run_at, user_id))
+    
+    _notification_heap.extend(entries)
+    heapq.heapify(_notification_heap)
+    _notification_wakeup.set()
+    return len(entries)
+
+def _pop_due_notifications() -> list:
+    """Извлечь из кучи всех пользователей, чье время уведомления наступило"""
+    now = time.time()
+    due = []
+    while _notification_heap and _notification_heap[0][0] <= now:
+        run_at, user_id = heapq.heappop(_notification_heap)
+        if _scheduled_at.get(user_id) != run_at:
+            continue  # Запись устарела (перепланирование или отключение)
+        del _scheduled_at[user_id]
+        due.append(user_id)
+    return due
+
+async def _notify_and_reschedule(user_id: int):
+    """Отправить уведомление и вернуть пользователя в кучу с новым next_run"""
+    await send_weather_notification(user_id)
+    schedule_user_notification(user_id)
+
+async def notification_loop():
+    """Единый цикл уведомлений: спит до ближайшего запуска в куче"""
+    while True:
+        _notification_wakeup.clear()
+        
+        due = _pop_due_notifications()
+        if due:
+            # Отправляем всем параллельно (с ограничением через семафор) в отдельной
+            # задаче, чтобы медленный API не задерживал следующие по времени запуски;
+            # новые next_run уходят в фоновую очередь записи и сохраняются пачкой
+            batch = asyncio.ensure_future(
+                asyncio.gather(*(_notify_and_reschedule(user_id) for user_id in due))
+            )
+            _notification_batches.add(batch)
+            batch.add_done_callback(_notification_batches.discard)
+            continue
+        
+        timeout = _notification_heap[0][0] - time.time() if _notification_heap else None
+        try:
+            await asyncio.wait_for(_notification_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 async def periodic_cache_cleanup():
     """Периодическая очистка устаревшего кэша"""
     try:
         deleted = cleanup_old_cache()
         if deleted > 0:
-            logger.info(f"Периодическая очистка: удалено {deleted} устаревших файлов кэша")
+            logger.info(f"Периодическая очистка: удалено {deleted} устаревших записей кэша")
     except Exception as e:
         logger.error(f"Ошибка периодической очистки кэша: {e}")
 
-# ============= ЗАПУСК БОТА =============
+async def cache_cleanup_loop():
+    """Запуск очистки кэша раз в CACHE_CLEANUP_INTERVAL_SECONDS"""
+    while True:
+        await asyncio.sleep(CACHE_CLEANUP_INTERVAL_SECONDS)
+        await periodic_cache_cleanup()
+
+async def start_background_tasks():
+    """Запуск цикла уведомлений и очистки кэша (dp.startup)"""
+    _background_tasks.append(asyncio.create_task(notification_loop()))
+    _background_tasks.append(asyncio.create_task(cache_cleanup_loop()))
+
+async def stop_background_tasks():
+    """Остановка фоновых задач (dp.shutdown)"""
+    for task in [*_background_tasks, *_notification_batches]:
+        task.cancel()
+    _background_tasks.clear()
+
+# "55.75, 37.62" или "55.75 37.62": два числа в записи float() ("+55.", ".5", "1e1"),
+# разделенные запятыми и/или пробелами
+_COORD_NUMBER = r'([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+_COORD_RE = re.compile(rf'^[\s,]*{_COORD_NUMBER}[\s,]+{_COORD_NUMBER}[\s,]*$')
 
-async def main():
-    """Главная функция запуска бота"""
-    # Регистрируем роутер
-    dp.include_router(router)
-    
-    # Настраиваем планировщик
-    scheduler.add_job(periodic_cache_cleanup, 'interval', hours=1)
-    
-    # Восстанавливаем задачи уведомлений
-    count = 0
 @router.message(F.text)
 async def handle_text_input(message: Message, state: FSMContext):
     """
@@ -1337,28 +1660,21 @@ async def handle_text_input(message: Message, state: FSMContext):
     text = message.text.strip()
     user_id = message.from_user.id
     
-    # 1. Пробуем парсить как координаты "lat, lon"
-    try:
-        parts = text.replace(',', ' ').split()
-        if len(parts) == 2:
-            lat = float(parts[0])
-            lon = float(parts[1])
-            
-            # Проверка диапазона
-            if (-90 <= lat <= 90) and (-180 <= lon <= 180):
-                weather_data = get_weather_by_coordinates(lat, lon)
+    # 1. Пробуем парсить как координаты "lat, lon" (названия городов отсеиваются регуляркой)
+    match = _COORD_RE.match(text)
+    if match:
+        lat = float(match[1])
+        lon = float(match[2])
+        
+        # Проверка диапазона
+        if (-90 <= lat <= 90) and (-180 <= lon <= 180):
+            try:
+                lat, lon = normalize_coordinates(lat, lon)
+                weather_data = await get_weather_by_coordinates(lat, lon)
                 city_name = weather_data['name'] # Обычно API возвращает ближайший населенный пункт
                 
                 # Сохраняем и показываем
                 update_user_location(user_id, lat, lon, city_name)
-                
-                # Удаляем возможную клавиатуру
-                try:
-                    del_msg = await message.answer("...", reply_markup=ReplyKeyboardRemove())
-                    await del_msg.delete()
-                except:
-                    pass
-
                 formatted_message = format_weather_message(weather_data)
                 
                 await message.answer(
@@ -1367,16 +1683,13 @@ async def handle_text_input(message: Message, state: FSMContext):
                     reply_markup=get_weather_actions_menu(lat, lon)
                 )
                 return
-    except ValueError:
-        pass # Не числовые координаты
-    except Exception as e:
-        logger.error(f"Ошибка при обработке координат в smart input: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка при обработке координат в smart input: {e}")
 
     # 2. Если не координаты, пробуем как название города
     try:
-        weather_data, city_name_ru = get_weather(text)
-        lat = weather_data['coord']['lat']
-        lon = weather_data['coord']['lon']
+        weather_data, city_name_ru = await get_weather(text)
+        lat, lon = normalize_coordinates(weather_data['coord']['lat'], weather_data['coord']['lon'])
         
         update_user_location(user_id, lat, lon, city_name_ru)
         formatted_message = format_weather_message(weather_data)
@@ -1396,26 +1709,57 @@ async def handle_text_input(message: Message, state: FSMContext):
 
 async def main():
     """Главная функция запуска бота"""
+    global BOT_USERNAME
+    
     # Регистрируем роутер
     dp.include_router(router)
-    
-    # Настраиваем планировщик
-    scheduler.add_job(periodic_cache_cleanup, 'interval', hours=1)
+    BOT_USERNAME = (await bot.get_me()).username
+    dp.startup.register(start_save_worker)
+    dp.startup.register(start_background_tasks)
+    dp.shutdown.register(stop_background_tasks)
+    dp.shutdown.register(stop_save_worker)
+    dp.shutdown.register(close_session)
     
     # Восстанавливаем задачи уведомлений
-    count = 0
-    for user_id in user_data:
-        if user_data[user_id].get('notification_data', {}).get('enabled'):
-            schedule_user_notification(user_id)
-            count += 1
-            
+    count = restore_notifications()
     logger.info(f"Восстановлено {count} задач уведомлений")
     
-    scheduler.start()
     logger.info("Бот запущен!")
     
-    # Запускаем polling
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        # Запускаем polling (webhook, если был установлен, мешает getUpdates)
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+
+async def run_webhook():
+    """
+    Запуск в режиме webhook
+    
+    Telegram сам присылает обновления на aiohttp-сервер, без цикла long polling.
+    """
+    # Серверная часть aiohttp нужна только в этом режиме: не загружаем ее при polling
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from aiohttp import web
+    
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    # Привязываем startup/shutdown диспетчера к жизненному циклу приложения
+    setup_application(app, dp, bot=bot)
+    
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
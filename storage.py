@@ -1,72 +1,267 @@
 import json
 import os
 import time
-import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
 from pathlib import Path
 
+# orjson (C-кодек) для всех JSON в хранилище; стандартный json - запасной вариант
+try:
+    import orjson
+    
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+    
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    
+    _loads = json.loads
+
 # Константы
-USER_DATA_FILE = "user_data.json"
+USER_DB_FILE = "users.db"
+USER_DATA_FILE = "user_data.json"  # Старый формат, импортируется в USER_DB_FILE при первом запуске
 CACHE_DIR = ".cache"
-CACHE_MAX_AGE_SECONDS = 600  # 10 минут
+CACHE_DB_FILE = os.path.join(CACHE_DIR, "cache.db")
+CACHE_MAX_AGE_SECONDS = 600  # 10 минут, если время жизни записи не указано явно
+MEMORY_CACHE_MAX_SIZE = 512  # Записей в памяти перед SQLite
 
 # Создаем директорию для кэша, если её нет
 Path(CACHE_DIR).mkdir(exist_ok=True)
 
+# Отложенные записи пользователей (свои для каждого потока, заполняются внутри batch_writes)
+_batch_state = threading.local()
+
+# Одно соединение на процесс (автокоммит, транзакции открываются явно);
+# обращения из разных потоков идут по очереди
+_conn = sqlite3.connect(USER_DB_FILE, isolation_level=None, check_same_thread=False)
+_conn.execute("PRAGMA journal_mode=WAL")
+_conn.execute("PRAGMA synchronous=NORMAL")
+_db_lock = threading.Lock()
+
+# Настройки уведомлений дублируются в отдельные колонки: при запуске включенные
+# пользователи выбираются по покрывающему частичному индексу, без разбора JSON
+# (user_id - это rowid и хранится в индексе сам)
+_conn.execute(
+    "CREATE TABLE IF NOT EXISTS users("
+    "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, "
+    "notif_enabled INTEGER NOT NULL DEFAULT 0, next_run REAL, notif_interval REAL)"
+)
+_conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_users_notif_schedule "
+    "ON users(notif_enabled, next_run, notif_interval) WHERE notif_enabled = 1"
+)
+
+# Кэш ответов API: LRU в памяти {key: (expires_at, data)} поверх таблицы SQLite
+_cache_conn = sqlite3.connect(CACHE_DB_FILE, isolation_level=None, check_same_thread=False)
+_cache_conn.execute("PRAGMA journal_mode=WAL")
+_cache_conn.execute("PRAGMA synchronous=NORMAL")
+_cache_lock = threading.Lock()
+_memory_cache = OrderedDict()
+
+# У каждой записи свое время жизни (expires_at); очистка удаляет по диапазону
+# expires_at, не просматривая всю таблицу
+_cache_conn.execute(
+    "CREATE TABLE IF NOT EXISTS cache("
+    "key TEXT PRIMARY KEY, cached_at REAL NOT NULL, expires_at REAL NOT NULL, data TEXT NOT NULL)"
+)
+_cache_conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache(expires_at)")
+
+# ============= МОДЕЛИ ДАННЫХ ПОЛЬЗОВАТЕЛЕЙ =============
+
+@dataclass(slots=True)
+class Location:
+    """Местоположение (нормализованные координаты и название)"""
+    lat: float
+    lon: float
+    city: str | None = None
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "Location":
+        return cls(lat=data['lat'], lon=data['lon'], city=data.get('city'))
+
+@dataclass(slots=True)
+class NotifData:
+    """Настройки погодных уведомлений"""
+    location: Location | None = None
+    enabled: bool = False
+    interval: float = 2  # часы
+    next_run: float = 0  # timestamp следующего уведомления
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "NotifData":
+        location = data.get('location')
+        return cls(
+            location=Location.from_dict(location) if location else None,
+            enabled=data.get('enabled', False),
+            interval=data.get('interval', 2),
+            next_run=data.get('next_run', 0)
+        )
+
+@dataclass(slots=True)
+class UserProfile:
+    """Данные пользователя: сохраненное местоположение и уведомления"""
+    location: Location | None = None
+    notification_data: NotifData | None = None
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserProfile":
+        location = data.get('location')
+        notification_data = data.get('notification_data')
+        return cls(
+            location=Location.from_dict(location) if location else None,
+            notification_data=NotifData.from_dict(notification_data) if notification_data else None
+        )
+
 # ============= РАБОТА С ДАННЫМИ ПОЛЬЗОВАТЕЛЕЙ =============
 
-def load_user(user_id: int) -> dict:
+def _migrate_legacy_users() -> None:
     """
-    Загрузить данные пользователя из файла
+    Однократно перенести пользователей из USER_DATA_FILE в базу
+    
+    Данные импортируются одной транзакцией, только если таблица пуста. Затем файл
+    атомарно (os.replace) переименовывается в *.migrated - в том числе когда
+    предыдущий запуск успел записать базу, но не переименовать файл.
+    Поврежденный файл остается на месте для ручного восстановления.
+    """
+    legacy = Path(USER_DATA_FILE)
+    if not legacy.exists():
+        return
+    
+    with _db_lock:
+        if not _conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            try:
+                all_users = _loads(legacy.read_bytes())
+            except ValueError:  # JSONDecodeError у обоих кодеков
+                return
+            _upsert_users(all_users)
+    
+    os.replace(legacy, legacy.with_name(legacy.name + ".migrated"))
+
+def load_user(user_id: int) -> UserProfile:
+    """
+    Загрузить данные пользователя из базы
     
     Args:
         user_id: ID пользователя Telegram
         
     Returns:
-        dict: Данные пользователя или пустой словарь, если пользователь не найден
+        UserProfile: Данные пользователя или пустой профиль, если пользователь не найден
     """
-    try:
-        with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-            all_users = json.load(f)
-            return all_users.get(str(user_id), {})
-    except FileNotFoundError:
-        return {}
-    except json.JSONDecodeError:
-        return {}
+    with _db_lock:
+        row = _conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return UserProfile.from_dict(_loads(row[0])) if row else UserProfile()
 
-def save_user(user_id: int, data: dict) -> None:
+def save_user(user_id: int, profile: UserProfile) -> None:
     """
-    Сохранить данные пользователя в файл
+    Сохранить данные пользователя в базу
+    
+    Внутри блока batch_writes() запись откладывается до выхода из блока.
     
     Args:
         user_id: ID пользователя Telegram
-        data: Данные для сохранения
+        profile: Данные для сохранения
     """
-    # Загружаем все данные
+    data = asdict(profile)
+    
+    pending = getattr(_batch_state, "pending", None)
+    if pending is not None:
+        pending[str(user_id)] = data
+        return
+    
+    _write_users({str(user_id): data})
+
+def _user_row(user_id, data: dict) -> tuple:
+    """Строка таблицы users: JSON целиком плюс колонки уведомлений"""
+    notif = data.get('notification_data') or {}
+    return (
+        int(user_id), _dumps(data),
+        1 if notif.get('enabled') else 0, notif.get('next_run'), notif.get('interval')
+    )
+
+def _upsert_users(updates: dict) -> None:
+    """Записать строки пользователей одной транзакцией (вызывается под _db_lock)"""
+    _conn.execute("BEGIN")
     try:
-        with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-            all_users = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        all_users = {}
+        _conn.executemany(
+            "INSERT INTO users(user_id, data, notif_enabled, next_run, notif_interval) VALUES(?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, notif_enabled = excluded.notif_enabled, "
+            "next_run = excluded.next_run, notif_interval = excluded.notif_interval",
+            [_user_row(user_id, data) for user_id, data in updates.items()]
+        )
+    except BaseException:
+        _conn.execute("ROLLBACK")
+        raise
+    _conn.execute("COMMIT")
+
+def _write_users(updates: dict) -> None:
+    """
+    Записать изменения нескольких пользователей одной транзакцией
     
-    # Обновляем данные пользователя
-    all_users[str(user_id)] = data
+    Args:
+        updates: Словарь {str(user_id): user_data}
+    """
+    with _db_lock:
+        _upsert_users(updates)
+
+@contextmanager
+def batch_writes():
+    """
+    Сгруппировать несколько вызовов save_user в одну транзакцию
+    
+    Внутри блока save_user только запоминает данные, а в базу они
+    записываются одной транзакцией при выходе. Вложенные блоки объединяются с внешним.
     
-    # Сохраняем обратно
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(all_users, f, ensure_ascii=False, indent=2)
+    Example:
+        >>> with batch_writes():
+        ...     save_user(1, data1)
+        ...     save_user(2, data2)  # Одна транзакция на обе записи
+    """
+    if getattr(_batch_state, "pending", None) is not None:
+        yield
+        return
+    
+    _batch_state.pending = {}
+    try:
+        yield
+    finally:
+        pending, _batch_state.pending = _batch_state.pending, None
+        if pending:
+            _write_users(pending)
 
 def load_all_users() -> dict:
     """
     Загрузить данные всех пользователей
     
     Returns:
-        dict: Словарь {user_id: user_data}
+        dict: Словарь {user_id: UserProfile}
     """
-    try:
-        with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    with _db_lock:
+        rows = _conn.execute("SELECT user_id, data FROM users").fetchall()
+    return {user_id: UserProfile.from_dict(_loads(data)) for user_id, data in rows}
+
+def load_notification_schedule() -> list:
+    """
+    Загрузить расписание пользователей с включенными уведомлениями
+    
+    Читает только покрывающий частичный индекс idx_users_notif_schedule:
+    выключенные строки и JSON профилей не затрагиваются.
+    
+    Returns:
+        list: Список кортежей (user_id, next_run, interval)
+    """
+    with _db_lock:
+        return _conn.execute(
+            "SELECT user_id, coalesce(next_run, 0), coalesce(notif_interval, 2) "
+            "FROM users WHERE notif_enabled = 1"
+        ).fetchall()
+
+# Переносим данные из старого JSON-файла при первом запуске
+_migrate_legacy_users()
 
 # ============= РАБОТА С КЭШЕМ API =============
 
@@ -92,27 +287,42 @@ def normalize_coordinates(lat: float, lon: float) -> tuple[float, float]:
     """
     return round(lat, 2), round(lon, 2)
 
-def _get_cache_key(lat: float, lon: float, endpoint: str) -> str:
+# Номера endpoint'ов в младших битах упакованного ключа кэша
+_ENDPOINT_ID = {"weather": 0, "forecast": 1, "air_pollution": 2}
+
+def _get_cache_key(lat: float, lon: float, endpoint: str) -> int | str:
     """
     Создать ключ кэша на основе координат и endpoint
     
+    Нормализованные координаты (в сотых долях градуса) и номер endpoint
+    упаковываются в одно целое число без хэширования и форматирования строк.
+    
     Args:
         lat: Широта
         lon: Долгота
-        endpoint: Название API endpoint (weather, forecast, air_pollution)
+        endpoint: Название API endpoint (weather, forecast, air_pollution
+            или geocoding_{город})
         
     Returns:
-        str: Хэш-ключ для кэша
+        int | str: Целочисленный ключ; для геокодинга - сама строка endpoint
     """
-    # Нормализуем координаты для группировки близких запросов
+    endpoint_id = _ENDPOINT_ID.get(endpoint)
+    if endpoint_id is None:
+        return endpoint  # Геокодинг не зависит от координат
+    
+    # Нормализуем координаты для группировки близких запросов;
+    # round(x * 100), а не int(x * 100): 0.29 * 100 == 28.999...
     norm_lat, norm_lon = normalize_coordinates(lat, lon)
-    key_string = f"{norm_lat:.2f}_{norm_lon:.2f}_{endpoint}"
-    # Создаем MD5 хэш для имени файла
-    return hashlib.md5(key_string.encode()).hexdigest()
+    lat_i = round(norm_lat * 100) + 9000     # 0..18000
+    lon_i = round(norm_lon * 100) + 18000    # 0..36000
+    return (lat_i * 36001 + lon_i) * 4 + endpoint_id
 
-def _get_cache_path(cache_key: str) -> str:
-    """Получить путь к файлу кэша"""
-    return os.path.join(CACHE_DIR, f"{cache_key}.json")
+def _remember(cache_key: int | str, expires_at: float, data: dict) -> None:
+    """Положить запись в LRU-кэш в памяти (вызывается под _cache_lock)"""
+    _memory_cache[cache_key] = (expires_at, data)
+    _memory_cache.move_to_end(cache_key)
+    if len(_memory_cache) > MEMORY_CACHE_MAX_SIZE:
+        _memory_cache.popitem(last=False)
 
 def get_cached_data(lat: float, lon: float, endpoint: str) -> dict | None:
     """
@@ -127,26 +337,34 @@ def get_cached_data(lat: float, lon: float, endpoint: str) -> dict | None:
         dict | None: Кэшированные данные или None, если кэш отсутствует/устарел
     """
     cache_key = _get_cache_key(lat, lon, endpoint)
-    cache_path = _get_cache_path(cache_key)
+    now = time.time()
     
-    try:
-        with open(cache_path, "r", encoding="utf-8") as f:
-            cache_data = json.load(f)
+    with _cache_lock:
+        # Сначала память, затем одна строка из SQLite
+        entry = _memory_cache.get(cache_key)
+        if entry is not None:
+            _memory_cache.move_to_end(cache_key)
+        else:
+            row = _cache_conn.execute(
+                "SELECT expires_at, data FROM cache WHERE key = ?", (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            entry = (row[0], _loads(row[1]))
+            _remember(cache_key, *entry)
         
-        # Проверяем возраст кэша
-        age = time.time() - cache_data.get("cached_at", 0)
+        expires_at, data = entry
+        # Проверяем срок жизни записи
+        if now < expires_at:
+            return data
         
-        if age < CACHE_MAX_AGE_SECONDS:
-            return cache_data.get("data")
-        else:
-            # Кэш устарел, удаляем
-            os.remove(cache_path)
-            return None
-            
-    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        # Кэш устарел, удаляем
+        del _memory_cache[cache_key]
+        _cache_conn.execute("DELETE FROM cache WHERE key = ?", (cache_key,))
         return None
 
-def save_cached_data(lat: float, lon: float, endpoint: str, data: dict) -> None:
+def save_cached_data(lat: float, lon: float, endpoint: str, data: dict,
+                     ttl_seconds: float = CACHE_MAX_AGE_SECONDS) -> None:
     """
     Сохранить данные в кэш
     
@@ -155,23 +373,18 @@ def save_cached_data(lat: float, lon: float, endpoint: str, data: dict) -> None:
         lon: Долгота (оригинальная)
         endpoint: Название API endpoint
         data: Данные для кэширования
+        ttl_seconds: Время жизни записи в секундах
     """
     cache_key = _get_cache_key(lat, lon, endpoint)
-    cache_path = _get_cache_path(cache_key)
+    cached_at = time.time()
+    expires_at = cached_at + ttl_seconds
     
-    # Нормализуем координаты для хранения
-    norm_lat, norm_lon = normalize_coordinates(lat, lon)
-    
-    cache_data = {
-        "lat": norm_lat,  # Сохраняем нормализованные координаты
-        "lon": norm_lon,
-        "endpoint": endpoint,
-        "cached_at": time.time(),
-        "data": data
-    }
-    
-    with open(cache_path, "w", encoding="utf-8") as f:
-        json.dump(cache_data, f, ensure_ascii=False, indent=2)
+    with _cache_lock:
+        _remember(cache_key, expires_at, data)
+        _cache_conn.execute(
+            "INSERT OR REPLACE INTO cache(key, cached_at, expires_at, data) VALUES(?, ?, ?, ?)",
+            (cache_key, cached_at, expires_at, _dumps(data))
+        )
 
 def clear_user_cache(old_lat: float, old_lon: float) -> None:
     """
@@ -182,48 +395,44 @@ def clear_user_cache(old_lat: float, old_lon: float) -> None:
         old_lon: Старая долгота
     """
     endpoints = ["weather", "forecast", "air_pollution"]
+    cache_keys = [_get_cache_key(old_lat, old_lon, endpoint) for endpoint in endpoints]
     
-    for endpoint in endpoints:
-        cache_key = _get_cache_key(old_lat, old_lon, endpoint)
-        cache_path = _get_cache_path(cache_key)
-        
-        try:
-            if os.path.exists(cache_path):
-                os.remove(cache_path)
-        except OSError:
-            pass  # Игнорируем ошибки удаления
+    with _cache_lock:
+        for cache_key in cache_keys:
+            _memory_cache.pop(cache_key, None)
+        _cache_conn.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in cache_keys])
 
 def cleanup_old_cache() -> int:
     """
-    Удалить все устаревшие файлы кэша
+    Удалить все устаревшие записи кэша
+    
+    Заодно удаляет файлы *.json, оставшиеся в CACHE_DIR от старого файлового
+    кэша: возраст берется из mtime (os.scandir), файлы не читаются.
     
     Returns:
-        int: Количество удаленных файлов
+        int: Количество удаленных записей и файлов
     """
-    deleted_count = 0
+    now = time.time()
+    
+    with _cache_lock:
+        for cache_key in [key for key, (expires_at, _) in _memory_cache.items() if expires_at <= now]:
+            del _memory_cache[cache_key]
+        deleted_count = _cache_conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,)).rowcount
+    
+    # Для старых файлов время жизни не записано - используем значение по умолчанию
+    expired_before = now - CACHE_MAX_AGE_SECONDS
     
     try:
-        for filename in os.listdir(CACHE_DIR):
-            if filename.endswith(".json"):
-                filepath = os.path.join(CACHE_DIR, filename)
-                
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
                 try:
-                    with open(filepath, "r", encoding="utf-8") as f:
-                        cache_data = json.load(f)
-                    
-                    age = time.time() - cache_data.get("cached_at", 0)
-                    
-                    if age >= CACHE_MAX_AGE_SECONDS:
-                        os.remove(filepath)
-                        deleted_count += 1
-                        
-                except (json.JSONDecodeError, KeyError, OSError):
-                    # Если файл поврежден, удаляем его
-                    try:
-                        os.remove(filepath)
+                    if entry.stat().st_mtime < expired_before:
+                        os.remove(entry.path)
                         deleted_count += 1
-                    except OSError:
-                        pass
+                except OSError:
+                    pass  # Файл уже удален или недоступен
     except OSError:
         pass
     
@@ -1,80 +1,319 @@
-import requests
+import asyncio
+import logging
+import random
+import time
+from bisect import bisect_right
+import httpx
 from dotenv import load_dotenv
 import os
+import re
 import json
-import time
+import unicodedata
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+from urllib.parse import quote
 from storage import get_cached_data, save_cached_data
 
+# orjson (C-кодек) для разбора ответов API; стандартный json - запасной вариант
+try:
+    import orjson
+    
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 API_KEY = os.getenv("OW_API_KEY")
+if not API_KEY:
+    raise ValueError("OW_API_KEY не найден в .env файле")
+# Лимит запросов к API в минуту (бесплатный тариф OpenWeather - 60)
+API_RATE_LIMIT = int(os.getenv("OW_RATE_LIMIT", "60"))
+
+# ============= ОШИБКИ =============
+
+class WeatherError(Exception):
+    """Базовая ошибка клиента OpenWeather"""
+
+class BadRequestError(WeatherError):
+    """API отклонил запрос (400)"""
+    def __init__(self, message: str = "Ошибка в запросе, введите название города или координаты"):
+        super().__init__(message)
+
+class AuthError(WeatherError):
+    """Неверный API ключ (401)"""
+    def __init__(self, message: str = "Ошибка авторизации. Проверьте API ключ"):
+        super().__init__(message)
+
+class ServiceUnavailableError(WeatherError, ConnectionError):
+    """API недоступен после всех повторных попыток"""
+    def __init__(self, message: str = "Не удалось подключиться"):
+        super().__init__(message)
+
+class NoDataError(WeatherError):
+    """API вернул пустой ответ"""
+
+class CityNotFoundError(NoDataError):
+    """Город не найден геокодингом"""
+    def __init__(self, city: str):
+        super().__init__(f"Город {city} не найден")
+        self.city = city
+
+# Шаблоны URL: ключ и общие параметры подставляются один раз при импорте
+_DATA_PARAMS = f"&appid={API_KEY}&units=metric&lang=ru"
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather?lat={}&lon={}" + _DATA_PARAMS
+FORECAST_URL = "https://api.openweathermap.org/data/2.5/forecast?lat={}&lon={}" + _DATA_PARAMS
+AIR_POLLUTION_URL = "https://api.openweathermap.org/data/2.5/air_pollution?lat={}&lon={}&appid=" + API_KEY
+GEOCODING_URL = "https://api.openweathermap.org/geo/1.0/direct?q={}&appid=" + API_KEY
+
+# Время жизни кэша по типам данных (в секундах): координаты городов не меняются,
+# текущая погода устаревает быстрее прогноза и качества воздуха
+GEOCODING_CACHE_TTL = 30 * 24 * 3600
+WEATHER_CACHE_TTL = 600
+FORECAST_CACHE_TTL = 3600
+AIR_POLLUTION_CACHE_TTL = 3600
+
+# Один клиент на процесс: соединение с API переиспользуется между запросами,
+# а по HTTP/2 параллельные запросы (погода, прогноз, воздух) идут по одному
+# TCP/TLS-соединению. Создается лениво, при первом запросе
+HTTP_POOL_SIZE = 16
+# Сколько держать простаивающее соединение открытым (по умолчанию в httpx 5 с):
+# запросы пользователей приходят с паузами, и без этого почти каждый начинал бы новый TLS-хендшейк
+HTTP_KEEPALIVE_SECONDS = 60
+# Таймауты: 3 с на установку соединения, 5 с на чтение/запись
+HTTP_TIMEOUT = httpx.Timeout(5.0, connect=3.0)
+_client: httpx.AsyncClient | None = None
+
+# Повторные попытки при 429/5xx и сетевых ошибках
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Случайный запас сверх Retry-After, секунд
+RETRY_AFTER_JITTER = 1.0
+
+def _get_client() -> httpx.AsyncClient:
+    """Вернуть общий HTTP-клиент, создав его при первом обращении"""
+    global _client
+    if _client is None or _client.is_closed:
+        limits = httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE // 2,
+            keepalive_expiry=HTTP_KEEPALIVE_SECONDS
+        )
+        _client = httpx.AsyncClient(http2=True, timeout=HTTP_TIMEOUT, limits=limits)
+    return _client
+
+async def close_session():
+    """Закрыть общий HTTP-клиент (при остановке бота)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# Token bucket: до API_RATE_LIMIT запросов подряд, дальше - по одному
+# каждые 60 / API_RATE_LIMIT секунд. Запросы сверх лимита ждут локально,
+# а не получают 429 с последующим backoff
+_rate_tokens = float(API_RATE_LIMIT)
+_rate_updated = time.monotonic()
+
+async def _wait_rate_limit() -> None:
+    """
+    Дождаться свободного места в лимите запросов к API
+    
+    Токен резервируется сразу (баланс может уйти в минус), и каждый вызывающий
+    спит свое время независимо, не задерживая остальных. Между await нет
+    переключений задач, поэтому блокировка не нужна.
+    """
+    global _rate_tokens, _rate_updated
+    now = time.monotonic()
+    _rate_tokens = min(API_RATE_LIMIT, _rate_tokens + (now - _rate_updated) * API_RATE_LIMIT / 60)
+    _rate_updated = now
+    _rate_tokens -= 1
+    if _rate_tokens < 0:
+        await asyncio.sleep(-_rate_tokens * 60 / API_RATE_LIMIT)
+
+def _parse_retry_after(retry_after: str | None) -> float | None:
+    """
+    Разобрать заголовок Retry-After: число секунд или HTTP-дата
+    
+    Returns:
+        float | None: Сколько секунд ждать, None - заголовка нет или он некорректен
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+def _retry_delay(attempt: int, retry_after: str | None) -> float | None:
+    """
+    Задержка перед повторной попыткой
+    
+    Если сервер прислал Retry-After, это нижняя граница: ждем не меньше, чем он
+    просит, плюс небольшой случайный запас. Если просит ждать дольше
+    RETRY_MAX_DELAY, повторять не имеет смысла - возвращаем None.
+    Иначе экспоненциальная задержка со случайным множителем (jitter), который
+    разводит повторные запросы разных пользователей во времени.
+    """
+    server_delay = _parse_retry_after(retry_after)
+    if server_delay is not None:
+        if server_delay > RETRY_MAX_DELAY:
+            return None
+        return server_delay + random.uniform(0, RETRY_AFTER_JITTER)
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * (0.5 + random.random())
+
+# Запросы к API, выполняющиеся прямо сейчас: {url: задача}. Повторный запрос
+# того же URL ждет уже запущенный вместо отправки второго
+_inflight: dict[str, asyncio.Future] = {}
+
+async def make_api_request(url: str, error_msg: str) -> dict:
+    """
+    Выполнить запрос к API без дублей (single-flight)
+    
+    Пока запрос с таким URL не завершился, все вызывающие получают
+    результат (или исключение) одной и той же задачи. Результат общий,
+    поэтому вызывающие не должны его изменять.
+    
+    Args:
+        url: URL для запроса
+        error_msg: Сообщение об ошибке, если данные не получены
+    
+    Returns:
+        dict: JSON ответ от API
+    """
+    task = _inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_request(url, error_msg))
+        _inflight[url] = task
+        task.add_done_callback(lambda _: _inflight.pop(url, None))
+    # shield: отмена одного ожидающего не отменяет общий запрос
+    return await asyncio.shield(task)
 
-def make_api_request(url: str, error_msg: str, delay: int = 1) -> dict:
+async def _request(url: str, error_msg: str) -> dict:
     """
     Универсальная функция для выполнения API запросов с обработкой ошибок и повторными попытками
     
     Args:
         url: URL для запроса
         error_msg: Сообщение об ошибке, если данные не получены
-        delay: Задержка перед повторной попыткой (для рекурсии)
     
     Returns:
         dict: JSON ответ от API
     """
-    try:
-        response = requests.get(url)
-    except requests.exceptions.RequestException:
-        response = None
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        await _wait_rate_limit()
+        try:
+            response = await _get_client().get(url)
+        except httpx.TransportError:  # В том числе таймауты
+            status_code = None
+        else:
+            status_code = response.status_code
+            if status_code == 200:
+                data = _loads(response.content)
+            retry_after = response.headers.get("Retry-After")
 
-    if response is None or response.status_code >= 500 or response.status_code == 429:
-        if delay <= 4:
-            print(f"Сервер недоступен, повторная попытка через {delay} секунд")
-            time.sleep(delay)
-            delay *= 2
-            return make_api_request(url, error_msg, delay)
-        raise ConnectionError("Не удалось подключиться")
+        if status_code is not None and status_code < 500 and status_code != 429:
+            break
+        delay = _retry_delay(attempt, retry_after)
+        if attempt == MAX_RETRIES or delay is None:
+            raise ServiceUnavailableError()
+        
+        logger.warning(f"Сервер недоступен, повторная попытка через {delay:.1f} секунд")
+        await asyncio.sleep(delay)
 
-    check_status_code(response.status_code)
+    check_status_code(status_code)
     
-    data = response.json()
     if not data:
-        raise Exception(error_msg)
+        raise NoDataError(error_msg)
     return data
 
-def get_weather(city: str) -> tuple[dict, str]:
+async def get_weather(city: str) -> tuple[dict, str]:
     """
     Получить погоду по названию города
     
     Returns:
         tuple: (weather_data, city_name_ru)
     """
-    latitude, longitude, city_name = get_coordinates(city)    
-    weather_data = get_weather_by_coordinates(latitude, longitude, city_name)
+    latitude, longitude, city_name = await get_coordinates(city)
+    weather_data = await get_weather_by_coordinates(latitude, longitude, city_name)
     return weather_data, city_name
 
-def get_weather_by_coordinates(lat:float, lon:float, city_name:str = None) -> dict:
+async def get_full_report(city: str) -> tuple[dict, dict, dict, str]:
+    """
+    Получить текущую погоду, прогноз и загрязнение воздуха по названию города
+    
+    После геокодинга три запроса к API выполняются параллельно.
+    
+    Returns:
+        tuple: (weather_data, forecast_data, air_pollution_data, city_name_ru)
+    """
+    latitude, longitude, city_name = await get_coordinates(city)
+    weather_data, forecast_data, air_data = await asyncio.gather(
+        get_weather_by_coordinates(latitude, longitude, city_name),
+        get_hourly_weather(latitude, longitude),
+        get_air_pollution(latitude, longitude)
+    )
+    return weather_data, forecast_data, air_data, city_name
+
+async def get_weather_by_coordinates(lat:float, lon:float, city_name:str = None) -> dict:
     # Проверяем кэш
     cached = get_cached_data(lat, lon, "weather")
     if cached:
-        # Если передано локальное имя, добавляем его в кэшированные данные
+        # Если передано локальное имя, добавляем его в копию
+        # (кэшированный словарь общий для всех вызывающих)
         if city_name:
-            cached['_local_name'] = city_name
+            return {**cached, '_local_name': city_name}
         return cached
     
     # Запрашиваем данные из API
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={API_KEY}&units=metric&lang=ru"
-    data = make_api_request(url, f"Нет данных для координат ({lat}, {lon})")
-    
-    # Если передано локальное имя города, добавляем его в ответ
-    if city_name:
-        data['_local_name'] = city_name
+    url = WEATHER_URL.format(lat, lon)
+    data = await make_api_request(url, f"Нет данных для координат ({lat}, {lon})")
     
     # Сохраняем в кэш
-    save_cached_data(lat, lon, "weather", data)
+    save_cached_data(lat, lon, "weather", data, ttl_seconds=WEATHER_CACHE_TTL)
     
+    # Если передано локальное имя города, добавляем его в копию ответа
+    if city_name:
+        return {**data, '_local_name': city_name}
     return data
 
-def get_coordinates(city:str) -> tuple[float, float, str]:
+# Заведомо не название города: ссылка или текст без единой буквы (эмодзи, числа).
+# Набор символов не ограничиваем: в названиях бывают типографские апострофы,
+# скобки и разные дефисы ("Xi’an", "Frankfurt (Oder)")
+CITY_NAME_MAX_LENGTH = 64
+_URL_RE = re.compile(r"[a-z][a-z0-9+.-]*://|www\.")
+_LETTER_RE = re.compile(r"[^\W\d_]")
+
+def _is_city_name(name: str) -> bool:
+    """Может ли нормализованная строка быть названием города"""
+    return (
+        len(name) <= CITY_NAME_MAX_LENGTH
+        and _LETTER_RE.search(name) is not None
+        and _URL_RE.search(name) is None
+    )
+
+def normalize_city_name(city: str) -> str:
+    """
+    Нормализовать название города для ключа кэша и запроса геокодинга
+    
+    Example:
+        >>> normalize_city_name("  Санкт-Петербург ")
+        'санкт-петербург'
+        >>> normalize_city_name("New   York")
+        'new york'
+    """
+    return " ".join(unicodedata.normalize("NFKC", city).casefold().split())
+
+async def get_coordinates(city:str) -> tuple[float, float, str]:
     """
     Получить координаты города с кэшированием
     
@@ -84,22 +323,25 @@ def get_coordinates(city:str) -> tuple[float, float, str]:
     Returns:
         tuple: (lat, lon, city_name_ru)
     """
-    # Нормализуем название для кэша
-    cache_key = city.lower().strip()
+    # Нормализуем название: один ключ кэша и один запрос для "Москва ", "МОСКВА" и т.п.
+    cache_key = normalize_city_name(city)
+    
+    # Заведомо не название города (ссылка, эмодзи, длинный текст) - не тратим запрос к API
+    if not _is_city_name(cache_key):
+        raise CityNotFoundError(city)
     
-    # Проверяем кэш (используем lat=0, lon=0 как placeholder для geocoding)
-    # Реальный ключ будет: hash(0.0000_0.0000_geocoding_{city})
+    # Проверяем кэш (lat=0, lon=0 - placeholder, ключ geocoding_{город} от координат не зависит)
     cached = get_cached_data(0, 0, f"geocoding_{cache_key}")
     if cached:
         return cached['lat'], cached['lon'], cached['city_name']
     
     # Запрашиваем из API
-    url = f"https://api.openweathermap.org/geo/1.0/direct?q={city}&appid={API_KEY}"
-    data = make_api_request(url, f"Город {city} не найден")
-    
-    # Проверяем, что API вернул результаты
-    if not data or len(data) == 0:
-        raise Exception(f"Город {city} не найден")
+    url = GEOCODING_URL.format(quote(cache_key))
+    try:
+        data = await make_api_request(url, f"Город {city} не найден")
+    except NoDataError:
+        # Геокодинг возвращает пустой список, если город не найден
+        raise CityNotFoundError(city) from None
     
     # Возвращаем русское название города если есть, иначе английское    
     city_name = data[0].get("local_names", {}).get("ru", data[0]["name"])
@@ -108,39 +350,109 @@ def get_coordinates(city:str) -> tuple[float, float, str]:
     
     # Сохраняем в кэш
     cache_data = {"lat": lat, "lon": lon, "city_name": city_name}
-    save_cached_data(0, 0, f"geocoding_{cache_key}", cache_data)
+    save_cached_data(0, 0, f"geocoding_{cache_key}", cache_data, ttl_seconds=GEOCODING_CACHE_TTL)
     
     return lat, lon, city_name
 
-def get_hourly_weather(latitude: float, longitude: float) -> dict:
+async def get_coordinates_many(cities: list[str]) -> list[tuple[float, float, str]]:
+    """
+    Получить координаты нескольких городов параллельно
+    
+    Названия, совпадающие после нормализации, запрашиваются один раз.
+    
+    Args:
+        cities: Названия городов
+        
+    Returns:
+        list: (lat, lon, city_name_ru) для каждого города в порядке cities
+    """
+    unique = {normalize_city_name(city): city for city in cities}
+    results = await asyncio.gather(*(get_coordinates(city) for city in unique.values()))
+    by_key = dict(zip(unique, results))
+    return [by_key[normalize_city_name(city)] for city in cities]
+
+# Поля прогноза, которые использует бот: None - значение целиком,
+# dict - вложенные поля, список из одной схемы - схема для каждого элемента
+_FORECAST_FIELDS = {
+    "city": {"coord": None},
+    "list": [{
+        "dt": None,
+        "main": {"temp": None, "humidity": None},
+        "weather": [{"description": None, "icon": None}],
+        "wind": {"speed": None}
+    }]
+}
+
+def _project(data, schema):
+    """Оставить в ответе API только поля, перечисленные в schema"""
+    if isinstance(schema, list):
+        return [_project(item, schema[0]) for item in data]
+    return {
+        key: data[key] if fields is None else _project(data[key], fields)
+        for key, fields in schema.items() if key in data
+    }
+
+async def get_hourly_weather(latitude: float, longitude: float) -> dict:
     # Проверяем кэш
     cached = get_cached_data(latitude, longitude, "forecast")
     if cached:
         return cached
     
     # Запрашиваем данные из API
-    url = f"https://api.openweathermap.org/data/2.5/forecast?lat={latitude}&lon={longitude}&appid={API_KEY}&units=metric&lang=ru"
-    data = make_api_request(url, f"Нет данных для координат ({latitude}, {longitude})")
+    url = FORECAST_URL.format(latitude, longitude)
+    data = await make_api_request(url, f"Нет данных для координат ({latitude}, {longitude})")
     
-    # Сохраняем в кэш
-    save_cached_data(latitude, longitude, "forecast", data)
+    # Сохраняем в кэш только используемые поля (полный ответ - около 40 записей по ~20 полей)
+    data = _project(data, _FORECAST_FIELDS)
+    save_cached_data(latitude, longitude, "forecast", data, ttl_seconds=FORECAST_CACHE_TTL)
     
     return data
 
-def get_air_pollution(latitude: float, longitude: float) -> dict:
+async def get_air_pollution(latitude: float, longitude: float) -> dict:
     # Проверяем кэш
     cached = get_cached_data(latitude, longitude, "air_pollution")
-    if cached:
-        return cached['list'][0].get('components', {})
+    if cached is not None:
+        return cached
     
     # Запрашиваем данные из API
-    url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={latitude}&lon={longitude}&appid={API_KEY}"
-    data = make_api_request(url, f"Нет данных для координат ({latitude}, {longitude})")
+    url = AIR_POLLUTION_URL.format(latitude, longitude)
+    data = await make_api_request(url, f"Нет данных для координат ({latitude}, {longitude})")
     
-    # Сохраняем в кэш
-    save_cached_data(latitude, longitude, "air_pollution", data)
+    # Сохраняем в кэш только концентрации загрязнителей
+    components = data['list'][0].get('components', {})
+    save_cached_data(latitude, longitude, "air_pollution", components, ttl_seconds=AIR_POLLUTION_CACHE_TTL)
     
-    return data['list'][0].get('components', {})
+    return components
+
+# Таблицы качества воздуха строятся один раз при импорте и доступны только для чтения
+
+# Стандарты качества воздуха: верхние границы индексов 1-4 для каждого загрязнителя
+# (значение не меньше последней границы - индекс 5)
+AIR_QUALITY_THRESHOLDS = MappingProxyType({
+    "so2": (20, 80, 250, 350),
+    "no2": (40, 70, 150, 200),
+    "pm10": (20, 50, 100, 200),
+    "pm2_5": (10, 25, 50, 75),
+    "o3": (60, 100, 140, 180),
+    "co": (4400, 9400, 12400, 15400)
+})
+
+# Название качества воздуха для индексов 1-5
+AIR_QUALITY_STATUS_NAMES = ("Хорошее", "Удовлетворительное", "Умеренное", "Плохое", "Очень плохое")
+
+# Насколько загрязнитель превышает норму для индексов 1-5 (1 - "Хорошее", в норме)
+AIR_QUALITY_ASSESSMENTS = ("в норме", "немного повышен", "умеренно повышен", "значительно повышен", "критически повышен")
+
+POLLUTANT_NAMES = MappingProxyType({
+    "so2": "SO₂ (диоксид серы)",
+    "no2": "NO₂ (диоксид азота)",
+    "pm10": "PM₁₀ (твердые частицы)",
+    "pm2_5": "PM₂.₅ (мелкие частицы)",
+    "o3": "O₃ (озон)",
+    "co": "CO (угарный газ)",
+    "no": "NO (оксид азота)",
+    "nh3": "NH₃ (аммиак)"
+})
 
 def analyze_air_pollution(air_pollution_data: dict) -> dict:
     """
@@ -153,133 +465,40 @@ def analyze_air_pollution(air_pollution_data: dict) -> dict:
     Returns:
         dict: Результат анализа с общим индексом и детальной информацией
     """
-    # Стандарты качества воздуха (индекс: название, диапазоны для каждого загрязнителя)
-    standards = {
-        1: {
-            "name": "Хорошее",
-            "ranges": {
-                "so2": (0, 20),
-                "no2": (0, 40),
-                "pm10": (0, 20),
-                "pm2_5": (0, 10),
-                "o3": (0, 60),
-                "co": (0, 4400)
-            }
-        },
-        2: {
-            "name": "Удовлетворительное",
-            "ranges": {
-                "so2": (20, 80),
-                "no2": (40, 70),
-                "pm10": (20, 50),
-                "pm2_5": (10, 25),
-                "o3": (60, 100),
-                "co": (4400, 9400)
-            }
-        },
-        3: {
-            "name": "Умеренное",
-            "ranges": {
-                "so2": (80, 250),
-                "no2": (70, 150),
-                "pm10": (50, 100),
-                "pm2_5": (25, 50),
-                "o3": (100, 140),
-                "co": (9400, 12400)
-            }
-        },
-        4: {
-            "name": "Плохое",
-            "ranges": {
-                "so2": (250, 350),
-                "no2": (150, 200),
-                "pm10": (100, 200),
-                "pm2_5": (50, 75),
-                "o3": (140, 180),
-                "co": (12400, 15400)
-            }
-        },
-        5: {
-            "name": "Очень плохое",
-            "ranges": {
-                "so2": (350, float('inf')),
-                "no2": (200, float('inf')),
-                "pm10": (200, float('inf')),
-                "pm2_5": (75, float('inf')),
-                "o3": (180, float('inf')),
-                "co": (15400, float('inf'))
-            }
-        }
-    }
-    
-    # Определяем индекс для каждого загрязнителя
-    pollutant_indices = {}
-    for pollutant, value in air_pollution_data.items():
-        for index in range(1, 6):
-            if pollutant in standards[index]["ranges"]:
-                min_val, max_val = standards[index]["ranges"][pollutant]
-                if min_val <= value < max_val:
-                    pollutant_indices[pollutant] = index
-                    break
-    
-    # Общий индекс - максимальный из всех загрязнителей
-    overall_index = max(pollutant_indices.values()) if pollutant_indices else 1
-    overall_status = standards[overall_index]["name"]
-    
-    # Детальная информация о каждом загрязнителе
+    # Один проход: индекс и детальная информация о каждом загрязнителе,
+    # общий индекс - максимальный из всех загрязнителей
+    overall_index = 1
     details = []
-    pollutant_names = {
-        "so2": "SO₂ (диоксид серы)",
-        "no2": "NO₂ (диоксид азота)",
-        "pm10": "PM₁₀ (твердые частицы)",
-        "pm2_5": "PM₂.₅ (мелкие частицы)",
-        "o3": "O₃ (озон)",
-        "co": "CO (угарный газ)",
-        "no": "NO (оксид азота)",
-        "nh3": "NH₃ (аммиак)"
-    }
-    
     for pollutant, value in air_pollution_data.items():
-        if pollutant in pollutant_indices:
-            index = pollutant_indices[pollutant]
-            status = standards[index]["name"]
-            pollutant_name = pollutant_names.get(pollutant, pollutant.upper())
-            
-            # Определяем, превышает ли норму (индекс > 1 означает не "Хорошее")
-            if index == 1:
-                assessment = "в норме"
-            elif index == 2:
-                assessment = "немного повышен"
-            elif index == 3:
-                assessment = "умеренно повышен"
-            elif index == 4:
-                assessment = "значительно повышен"
-            else:
-                assessment = "критически повышен"
-            
-            details.append({
-                "pollutant": pollutant_name,
-                "value": f"{value} мкг/м³",
-                "index": index,
-                "status": status,
-                "assessment": assessment
-            })
+        thresholds = AIR_QUALITY_THRESHOLDS.get(pollutant)
+        if thresholds is None:
+            continue
+        index = bisect_right(thresholds, value) + 1
+        if index > overall_index:
+            overall_index = index
+        
+        details.append({
+            "pollutant": POLLUTANT_NAMES.get(pollutant, pollutant.upper()),
+            "value": f"{value} мкг/м³",
+            "index": index,
+            "status": AIR_QUALITY_STATUS_NAMES[index - 1],
+            "assessment": AIR_QUALITY_ASSESSMENTS[index - 1]
+        })
     
     return {
         "overall_index": overall_index,
-        "overall_status": overall_status,
+        "overall_status": AIR_QUALITY_STATUS_NAMES[overall_index - 1],
         "details": details
     }
 
 
 
 def check_status_code(status_code: int):
-    if status_code != 200:
-        if status_code == 400:
-            error_msg = "Ошибка в запросе, введите название города или координаты"
-        elif status_code == 401:
-            error_msg = "Ошибка авторизации. Проверьте API ключ"
-        else:
-            error_msg = f"Ошибка API: {status_code}"
-        raise Exception(error_msg)
+    if status_code == 200:
+        return
+    if status_code == 400:
+        raise BadRequestError()
+    if status_code == 401:
+        raise AuthError()
+    raise WeatherError(f"Ошибка API: {status_code}")
 